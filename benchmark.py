@@ -0,0 +1,1227 @@
+"""Benchmarks for the link blocker bot.
+
+Run everything with `python benchmark.py`, or pick suites with --suite.
+Results can be saved with --output and checked against an earlier run
+with --compare.
+"""
+import os
+import re
+import functools
+import json
+import time
+import random
+import asyncio
+import argparse
+import gc
+import contextlib
+import platform
+import tempfile
+import multiprocessing
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import discord
+
+import deepseek_python_20260112_f860cc as linkbot
+
+# Normal chat text, with the occasional link mixed in
+CHAT_LINES = [
+    "hey everyone, how's it going?",
+    "lol that was a good game last night",
+    "anyone up for ranked later",
+    "brb getting food",
+    "I think the patch notes said they nerfed it...",
+    "gg wp",
+    "does anyone know when the event starts? I missed the announcement",
+    "yeah the server was down for like an hour",
+    "ok. see you tomorrow",
+    "check out https://youtube.com/watch?v=dQw4w9WgXcQ",
+    "join discord.gg/abc123 for free stuff",
+    "my notes are on example.com/notes",
+]
+
+def build_corpus(size, seed=0):
+    """Build a repeatable corpus of chat messages"""
+    rng = random.Random(seed)
+    return [rng.choice(CHAT_LINES) for _ in range(size)]
+
+# The original patterns, including the backtracking general URL regex
+LEGACY_LINK_PATTERNS = {
+    'invite': r'(https?://)?(www\.)?(discord\.(gg|io|me|li)|discordapp\.com/invite)/[a-zA-Z0-9]+',
+    'youtube': r'(https?://)?(www\.)?(youtube\.com|youtu\.be)/[^\s]+',
+    'url': r'(https?://)?(www\.)?([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}(/\S*)?'
+}
+
+def legacy_contains_links(text):
+    """Original per-call re.search loop over the raw pattern strings"""
+    for pattern in LEGACY_LINK_PATTERNS.values():
+        if re.search(pattern, text, re.IGNORECASE):
+            return True
+    return False
+
+def run(name, func, corpus):
+    """Time func over the corpus and print messages/sec"""
+    start = time.perf_counter()
+    for text in corpus:
+        func(text)
+    elapsed = time.perf_counter() - start
+    rate = len(corpus) / elapsed if elapsed else float('inf')
+    print(f"{name:<24} {rate:>14,.0f} msg/s  ({elapsed * 1000:.1f} ms)")
+    return rate
+
+def bench_detection(size=200_000):
+    """Compare the legacy pattern loop against the compiled LinkDetector"""
+    corpus = build_corpus(size)
+    print(f"Link detection over {size:,} chat messages")
+    legacy = run("legacy re.search loop", legacy_contains_links, corpus)
+    compiled = run("LinkDetector.detect", linkbot.link_detector.detect, corpus)
+    print(f"Speedup: {compiled / legacy:.2f}x")
+    return {"legacy_msg_per_s": legacy, "detector_msg_per_s": compiled}
+
+def legacy_save_data(data):
+    """Original synchronous, non-atomic save_data"""
+    with open(linkbot.DATA_FILE, 'w') as f:
+        json.dump(data, f, indent=4)
+
+async def measure_stall(work):
+    """Run work while a 1 ms ticker records how late the event loop wakes it"""
+    loop = asyncio.get_running_loop()
+    stalls = []
+    done = False
+
+    async def ticker():
+        while not done:
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            stalls.append(loop.time() - start - 0.001)
+
+    # A full collection owed by earlier work would otherwise land in whatever runs next
+    gc.collect()
+    task = loop.create_task(ticker())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - start
+    done = True
+    await task
+    return max(stalls), sum(stalls), elapsed
+
+async def bench_persistence_async(entries, mutations):
+    rng = random.Random(0)
+    linkbot.bot.whitelist_data = {
+        **linkbot.empty_entries(),
+        "whitelisted_users": rng.sample(range(10**17, 10**18), entries),
+        "whitelisted_roles": rng.sample(range(10**17, 10**18), entries // 10),
+        "guilds": {},
+    }
+    linkbot.bot.permission_indexes = {}
+    journal_file = linkbot.DATA_FILE + '.journal'
+    database_file = linkbot.DATA_FILE + '.db'
+
+    async def legacy(new_ids):
+        for user_id in new_ids:
+            linkbot.bot.whitelist_data["whitelisted_users"].append(user_id)
+            legacy_save_data(linkbot.bot.whitelist_data)
+            await asyncio.sleep(0)
+
+    async def debounced(new_ids):
+        for user_id in new_ids:
+            linkbot.set_whitelisted(linkbot.GLOBAL_GUILD_ID, "users", user_id, True)
+            await asyncio.sleep(0)
+        await linkbot.data_writer.task
+
+    async def journaled(new_ids):
+        linkbot.storage = linkbot.JournalBackend(journal_file, linkbot.JOURNAL_COMPACT_AFTER)
+        await debounced(new_ids)
+
+    async def sqlite(new_ids):
+        linkbot.storage = linkbot.SqliteBackend(database_file)
+        await debounced(new_ids)
+
+    results = {}
+    print(f"Persistence with {entries:,} entries, {mutations} changes in a burst")
+    for name, work in (("legacy save_data", legacy), ("DataWriter + json", debounced),
+                       ("DataWriter + journal", journaled), ("DataWriter + sqlite", sqlite)):
+        new_ids = rng.sample(range(10**16), mutations)
+        worst, total, elapsed = await measure_stall(functools.partial(work, new_ids))
+        print(f"{name:<24} max stall {worst * 1000:>8.2f} ms  "
+              f"total stall {total * 1000:>9.2f} ms  ({elapsed * 1000:.1f} ms)")
+        results[name] = {"max_stall_ms": worst * 1000, "total_stall_ms": total * 1000}
+    
+    # The save alone, already off the loop: how long the encoder makes the loop wait
+    loop = asyncio.get_running_loop()
+    data = {**linkbot.empty_entries(), "whitelisted_users": rng.sample(range(10**17, 10**18), entries * 10), "guilds": {}}
+    for name, save in (("json.dump indent=4", legacy_save_data), ("save_data", linkbot.save_data)):
+        async def saves():
+            for _ in range(5):
+                await loop.run_in_executor(None, save, data)
+        worst, total, elapsed = await measure_stall(saves)
+        print(f"{name:<24} max stall {worst * 1000:>8.2f} ms  "
+              f"total stall {total * 1000:>9.2f} ms  ({elapsed * 1000:.1f} ms, 5 saves of {entries * 10:,} entries)")
+        results[name] = {"max_stall_ms": worst * 1000, "total_stall_ms": total * 1000}
+    return results
+
+def bench_persistence(entries=10_000, mutations=50):
+    """Compare event loop stalls of synchronous saves against DataWriter"""
+    data_before, storage_before = linkbot.bot.whitelist_data, linkbot.storage
+    with tempfile.TemporaryDirectory() as tmp:
+        linkbot.DATA_FILE = os.path.join(tmp, 'whitelist_data.json')
+        linkbot.data_writer.delay = 0.05
+        try:
+            return asyncio.run(bench_persistence_async(entries, mutations))
+        finally:
+            # The journal and SQLite backends point into tmp, which is about to go
+            linkbot.bot.whitelist_data, linkbot.storage = data_before, storage_before
+            linkbot.bot.permission_indexes = {}
+
+class FakeAPI:
+    """Stand-in for Discord's REST API with a global request rate limit"""
+
+    def __init__(self, rate, latency):
+        self.rate = rate
+        self.latency = latency
+        self.calls = Counter()
+        self.next_slot = 0.0
+
+    async def call(self, name):
+        self.calls[name] += 1
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self.next_slot)
+        self.next_slot = start + 1 / self.rate
+        await asyncio.sleep(start - now + self.latency)
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.members = []
+        self.roles = {}
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+class FakeRole:
+    def __init__(self, role_id, guild=None):
+        self.id = role_id
+        self.name = f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+        self.guild = guild
+
+    @property
+    def members(self):
+        # Like discord.py, a role finds its members by walking the guild's
+        return [member for member in self.guild.members if self in member.roles]
+
+class FakeMember:
+    def __init__(self, api, member_id, guild, roles=()):
+        self.api = api
+        self.id = member_id
+        self.name = f"user{member_id}"
+        self.mention = f"<@{member_id}>"
+        self.bot = False
+        self.discriminator = "0"
+        self.guild = guild
+        self.roles = list(roles)
+
+    async def send(self, content=None, **kwargs):
+        await self.api.call('dm')
+
+    async def timeout(self, until, reason=None):
+        await self.api.call('timeout')
+
+class FakeChannel:
+    def __init__(self, api, channel_id, guild):
+        self.api = api
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.guild = guild
+
+    async def send(self, content=None, **kwargs):
+        await self.api.call('send')
+        return FakeMessage(self.api, 0, content or "", None, self)
+
+    async def delete_messages(self, messages):
+        await self.api.call('bulk_delete')
+
+class FakeResponse:
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+class FakeInvites:
+    """Stand-in for the invite endpoint: code -> guild ID, unknown codes 404"""
+
+    def __init__(self, api, guilds):
+        self.api = api
+        self.guilds = guilds
+
+    async def fetch(self, code):
+        await self.api.call('fetch_invite')
+        if code not in self.guilds:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Invite")
+        return self.guilds[code]
+
+def stand_in_resolver(invites, delay=0.0):
+    """An InviteResolver that fetches from a FakeInvites instead of Discord"""
+    cache = linkbot.DecisionCache(linkbot.INVITE_CACHE_SIZE, linkbot.INVITE_CACHE_TTL)
+    return linkbot.InviteResolver(invites.fetch, cache, linkbot.INVITE_NEGATIVE_TTL,
+                                  delay, linkbot.INVITE_FETCH_CONCURRENCY)
+
+@contextlib.contextmanager
+def moderation_only():
+    """Swap command dispatch for a no-op while a suite feeds on_message
+
+    The fakes can't build a discord.py Context, so every suite that sends
+    messages through on_message installs this itself instead of relying on
+    another suite having run first.
+    """
+    async def no_commands(message):
+        pass
+    linkbot.bot.process_commands = no_commands
+    try:
+        yield
+    finally:
+        del linkbot.bot.process_commands
+
+class FakeMessage:
+    def __init__(self, api, message_id, content, author, channel):
+        self.api = api
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = []
+        self.embeds = []
+
+    async def delete(self, delay=None):
+        # Delayed deletes are scheduled client-side by discord.py
+        if delay is None:
+            await self.api.call('delete')
+
+    async def edit(self, **kwargs):
+        await self.api.call('edit')
+
+def build_violations(api, count, channels, users):
+    """Spread count link messages over the given channels and users"""
+    guild = FakeGuild(1)
+    channel_list = [FakeChannel(api, 1000 + i, guild) for i in range(channels)]
+    members = [FakeMember(api, 10**17 + i, guild) for i in range(users)]
+    violations = []
+    for i in range(count):
+        content = f"free nitro at discord.gg/raid{i % 7} and https://spam{i % 13}.example.com/x"
+        message = FakeMessage(api, i, content, members[i % users], channel_list[i % channels])
+        violations.append(linkbot.Violation(message, linkbot.link_detector.extract(content)))
+    return violations
+
+async def legacy_handle(violation):
+    """Original per-message flow: delete, log, warning and DM in turn"""
+    message = violation.message
+    await message.delete()
+    log_message = await message.channel.send(embed=linkbot.build_log_embed(violation))
+    await log_message.delete(delay=30)
+    await message.channel.send(f"{message.author.mention}, Only whitelisted users can post links!", delete_after=10)
+    await message.author.send(embed=linkbot.build_dm_embed(violation))
+
+async def bench_actions_async(count, channels, users, rate, latency):
+    results = {}
+    print(f"Action pipeline: {count:,} violations, {channels} channels, {users} users, "
+          f"{rate} req/s global limit")
+    for name in ("legacy per-message", "ActionQueue"):
+        api = FakeAPI(rate, latency)
+        violations = build_violations(api, count, channels, users)
+        start = time.perf_counter()
+        if name == "ActionQueue":
+            queue = linkbot.ActionQueue(0.05, linkbot.ACTION_CONCURRENCY)
+            for violation in violations:
+                queue.submit(violation.message, violation.links)
+            while queue.tasks:
+                await asyncio.gather(*list(queue.tasks.values()))
+        else:
+            await asyncio.gather(*(legacy_handle(violation) for violation in violations))
+        elapsed = time.perf_counter() - start
+        calls = sum(api.calls.values())
+        print(f"{name:<24} {count / elapsed:>10,.1f} violations/s  {calls:>6} API calls  "
+              f"({elapsed:.2f} s)  {dict(api.calls)}")
+        results[name] = {"violations_per_s": count / elapsed, "api_calls": calls}
+    return results
+
+def bench_actions(count=500, channels=10, users=50, rate=200, latency=0.005):
+    """Load test the moderation pipeline against a rate-limited fake client"""
+    return asyncio.run(bench_actions_async(count, channels, users, rate, latency))
+
+async def bench_flood_async(count, spacing):
+    results = {}
+    print(f"Link flood: one member posts {count} links, {spacing * 1000:.0f} ms apart")
+    # A threshold above the flood size never escalates, like before the tracker
+    for name, threshold in (("warn every batch", count + 1), ("ViolationTracker", linkbot.VIOLATION_THRESHOLD)):
+        api = FakeAPI(rate=10**6, latency=0)
+        linkbot.violation_tracker = linkbot.ViolationTracker(threshold, linkbot.VIOLATION_WINDOW, linkbot.VIOLATION_TRACKER_SIZE)
+        queue = linkbot.ActionQueue(spacing / 2, linkbot.ACTION_CONCURRENCY)
+        violations = build_violations(api, count, 1, 1)
+        for violation in violations:
+            queue.submit(violation.message, violation.links)
+            await asyncio.sleep(spacing)
+        while queue.tasks:
+            await asyncio.gather(*list(queue.tasks.values()))
+        calls = sum(api.calls.values())
+        print(f"{name:<24} {calls:>6} API calls  {dict(api.calls)}")
+        results[name] = {"api_calls": calls, "calls": dict(api.calls)}
+    return results
+
+async def bench_raid_async(count, accounts, payloads):
+    rng = random.Random(0)
+    results = {}
+    print(f"Raid: {count:,} messages from {accounts} accounts, {payloads} distinct payloads, 10 channels")
+    # A cache that holds nothing turns fingerprinting off
+    for name, size, threshold in (("scan every message", 0, count + 1),
+                                  ("fingerprints + raid mode", linkbot.FINGERPRINT_CACHE_SIZE, linkbot.RAID_THRESHOLD)):
+        api = FakeAPI(rate=10**6, latency=0)
+        guild = FakeGuild(1)
+        channels = [FakeChannel(api, 2000 + i, guild) for i in range(10)]
+        members = [FakeMember(api, 10**17 + i, guild) for i in range(accounts)]
+        spam = [f"FREE NITRO for everyone https://nitro-gift{n}.example.com/claim discord.gg/raid{n}"
+                for n in range(payloads)]
+        linkbot.spam_fingerprints = linkbot.DecisionCache(size, linkbot.FINGERPRINT_TTL)
+        linkbot.raid_monitor = linkbot.RaidMonitor(threshold, 0.2, 0.05)
+        linkbot.violation_tracker = linkbot.ViolationTracker(linkbot.VIOLATION_THRESHOLD, linkbot.VIOLATION_WINDOW,
+                                                             linkbot.VIOLATION_TRACKER_SIZE)
+        linkbot.invite_resolver = stand_in_resolver(FakeInvites(api, defaultdict(lambda: 2)))
+        linkbot.action_queue = linkbot.ActionQueue(0.05, linkbot.ACTION_CONCURRENCY)
+        
+        handling = 0.0
+        for i in range(count):
+            message = FakeMessage(api, i, rng.choice(spam), members[i % accounts], channels[i % len(channels)])
+            start = time.perf_counter()
+            await linkbot.on_message(message)
+            handling += time.perf_counter() - start
+            if i % 50 == 49:
+                await asyncio.sleep(0.01)
+        while linkbot.action_queue.tasks or linkbot.raid_monitor.raids:
+            await asyncio.sleep(0.05)
+        calls = sum(api.calls.values())
+        print(f"{name:<26} on_message {handling / count * 1e6:>7.1f} us/msg  {calls:>5} API calls  {dict(api.calls)}")
+        results[name] = {"us_per_message": handling / count * 1e6, "api_calls": calls}
+    return results
+
+def bench_raid(count=2_000, accounts=300, payloads=3):
+    """Compare a copy-paste raid with and without payload fingerprints and raid mode"""
+    with moderation_only():
+        return asyncio.run(bench_raid_async(count, accounts, payloads))
+
+def bench_flood(count=50, spacing=0.02):
+    """Count API calls for one member flooding links, with and without escalation"""
+    return asyncio.run(bench_flood_async(count, spacing))
+
+# Replay harness
+# Feeds message corpora through the real on_message handler using the fake
+# members and channels above. Command dispatch is swapped for a no-op since
+# the fakes can't build a discord.py Context; everything else is the live
+# moderation path, including the action queue against a zero-latency API.
+
+LOG_LINES = [
+    "2024-05-01 12:00:01 INFO  worker[3] processed batch 1182 in 42ms",
+    "2024-05-01 12:00:01 WARN  cache miss ratio 0.37 above threshold 0.25",
+    "Traceback (most recent call last):",
+    '  File "/srv/app/handlers.py", line 88, in dispatch',
+    "    result = handler(event, context=ctx)",
+    "KeyError: 'session_id'",
+    "2024-05-01 12:00:02 DEBUG retry 2/5 for job=reindex shard=7",
+]
+
+def short_chat(rng, count):
+    return [rng.choice(CHAT_LINES) for _ in range(count)]
+
+def long_logs(rng, count):
+    """Pasted logs near the 4000 character Nitro limit"""
+    return ["\n".join(rng.choice(LOG_LINES) for _ in range(60))[:4000] for _ in range(count)]
+
+def url_spam(rng, count):
+    return [
+        " ".join(f"https://free-nitro{rng.randrange(100)}.example.com/claim?id={rng.randrange(10**6)} discord.gg/raid{rng.randrange(50)}"
+                 for _ in range(rng.randrange(1, 6)))
+        for _ in range(count)
+    ]
+
+# Dotted and hyphenated runs that look like hosts but never end in a TLD
+NEAR_URL_SHAPES = {
+    "dotted": lambda n: "a." * n + "1",
+    "hyphenated": lambda n: "a-" * n + ".1",
+    "labels": lambda n: ("x" * 8 + ".") * (n // 8) + "9",
+    "word_dot": lambda n: "a" * (2 * n) + ".",
+}
+
+def near_urls(rng, count):
+    """Near-URLs that made the old general URL regex backtrack"""
+    shapes = list(NEAR_URL_SHAPES.values())[:3]
+    return [rng.choice(shapes)(rng.randrange(500, 2000)) for _ in range(count)]
+
+SCENARIOS = {
+    "short_chat": (short_chat, 20_000),
+    "long_logs": (long_logs, 500),
+    "url_spam": (url_spam, 5_000),
+    "near_urls": (near_urls, 100),
+}
+
+def load_recorded(path):
+    """Read a recorded corpus: a JSON list of strings or one message per line"""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        return [str(message) for message in json.loads(text)]
+    except ValueError:
+        return text.splitlines()
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+async def replay_async(contents):
+    """Push contents through on_message; return per-message latencies"""
+    api = FakeAPI(rate=10**6, latency=0)
+    guild = FakeGuild(1)
+    channels = [FakeChannel(api, 2000 + i, guild) for i in range(10)]
+    members = [FakeMember(api, 10**17 + i, guild) for i in range(200)]
+    linkbot.action_queue = linkbot.ActionQueue(0, linkbot.ACTION_CONCURRENCY)
+    # Every invite resolves to some other guild, so invites are still deleted
+    linkbot.invite_resolver = stand_in_resolver(FakeInvites(api, defaultdict(lambda: 2)))
+    latencies = []
+    for i, content in enumerate(contents):
+        message = FakeMessage(api, i, content, members[i % len(members)], channels[i % len(channels)])
+        start = time.perf_counter()
+        await linkbot.on_message(message)
+        latencies.append(time.perf_counter() - start)
+    while linkbot.action_queue.tasks:
+        await asyncio.gather(*list(linkbot.action_queue.tasks.values()))
+    return latencies
+
+def replay(name, contents):
+    """Time one corpus through on_message, then measure its peak memory"""
+    start = time.perf_counter()
+    latencies = asyncio.run(replay_async(contents))
+    elapsed = time.perf_counter() - start
+    
+    # Separate pass: tracemalloc slows everything down too much to time with
+    tracemalloc.start()
+    asyncio.run(replay_async(contents))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    
+    latencies.sort()
+    result = {
+        "messages": len(contents),
+        "msg_per_s": len(contents) / elapsed if elapsed else float('inf'),
+        "p50_us": percentile(latencies, 0.50) * 1e6,
+        "p95_us": percentile(latencies, 0.95) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "max_us": latencies[-1] * 1e6 if latencies else 0.0,
+        "peak_memory_kb": peak / 1024,
+    }
+    print(f"{name:<14} {result['msg_per_s']:>12,.0f} msg/s  p50 {result['p50_us']:>9.1f} us  "
+          f"p95 {result['p95_us']:>9.1f} us  p99 {result['p99_us']:>10.1f} us  "
+          f"peak {result['peak_memory_kb']:>9,.0f} KiB")
+    return result
+
+def bench_replay(scenarios=None, corpus_file=None, scale=1.0, seed=0):
+    """Replay synthetic scenarios (and an optional recorded corpus) through on_message"""
+    rng = random.Random(seed)
+    results = {}
+    print("Replay through on_message")
+    with moderation_only():
+        for name in scenarios or SCENARIOS:
+            build, count = SCENARIOS[name]
+            results[name] = replay(name, build(rng, max(1, int(count * scale))))
+        if corpus_file:
+            results["recorded"] = replay("recorded", load_recorded(corpus_file))
+    return results
+
+async def bench_scanning_async(size, count):
+    rng = random.Random(0)
+    lines = LOG_LINES + [f"see https://mirror{n}.example.com/build/{n}.tar.gz" for n in range(5)]
+    text = "\n".join(rng.choice(lines) for _ in range(size // 40))[:size]
+    expected = linkbot.link_detector.extract(text)
+    
+    async def inline():
+        for _ in range(count):
+            assert linkbot.link_detector.extract(text) == expected
+            await asyncio.sleep(0)
+    
+    async def pooled():
+        results = await asyncio.gather(*(linkbot.scan_pool.extract(text) for _ in range(count)))
+        assert all(links == expected for links in results)
+    
+    results = {}
+    print(f"Scanning {count} texts of {len(text):,} characters ({len(expected)} links each)")
+    for name, work in (("inline on the loop", inline), ("ScanPool processes", pooled)):
+        worst, total, elapsed = await measure_stall(work)
+        print(f"{name:<24} max stall {worst * 1000:>8.2f} ms  "
+              f"total stall {total * 1000:>9.2f} ms  ({elapsed * 1000:.1f} ms)")
+        results[name] = {"max_stall_ms": worst * 1000, "total_stall_ms": total * 1000}
+    return results
+
+def bench_scanning(size=100_000, count=20):
+    """Compare event loop stalls from scanning large texts inline and on the scan pool"""
+    # The bot forks its workers before its event loop starts; do the same
+    linkbot.scan_pool.start()
+    return asyncio.run(bench_scanning_async(size, count))
+
+def random_domain(rng, labels):
+    return ".".join("".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789") for _ in range(rng.randrange(3, 10)))
+                    for _ in range(labels))
+
+def bench_domains(sizes=(1_000, 10_000, 100_000), lookups=100_000, seed=0):
+    """Time DomainTrie builds and lookups as the rule count grows, over one fixed set of hosts"""
+    rng = random.Random(seed)
+    results = {}
+    # Smaller rule sets are prefixes of the largest, and the hosts only hit
+    # rules in the smallest, so the rule count is the only thing that changes
+    rules = [random_domain(rng, rng.randrange(2, 4)) for _ in range(max(sizes))]
+    hosts = []
+    for _ in range(lookups):
+        if rng.random() < 0.5:
+            host = rng.choice(rules[:min(sizes)])
+            hosts.append(".".join([random_domain(rng, 1)] * rng.randrange(0, 2) + [host]))
+        else:
+            hosts.append(random_domain(rng, rng.randrange(2, 6)))
+    print(f"Domain rule lookups (the same {lookups:,} hosts of 2-5 labels for every size, half covered by a rule)")
+    for size in sizes:
+        entries = linkbot.empty_entries()
+        for n, rule in enumerate(rules[:size]):
+            kind = "allowed" if n % 2 else "blocked"
+            entries[linkbot.ENTRY_KEYS[kind]].append(f"*.{rule}" if n % 3 else rule)
+        
+        start = time.perf_counter()
+        trie = linkbot.DomainTrie(entries)
+        built = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        matched = sum(trie.lookup(host) is not None for host in hosts)
+        elapsed = time.perf_counter() - start
+        per_lookup = elapsed / lookups * 1e9
+        print(f"{size:>9,} rules  build {built * 1000:>8.1f} ms  lookup {per_lookup:>7.0f} ns  ({matched:,} matched)")
+        results[str(size)] = {"build_ms": built * 1000, "lookup_ns": per_lookup}
+    return results
+
+async def bench_invites_async(count, latency):
+    rng = random.Random(0)
+    api = FakeAPI(rate=1000, latency=latency)
+    guild = FakeGuild(1)
+    own = [f"own{n}" for n in range(20)]
+    other = [f"other{n}" for n in range(20)]
+    invalid = [f"fake{n}" for n in range(50)]
+    invites = FakeInvites(api, {**dict.fromkeys(own, guild.id), **dict.fromkeys(other, 2)})
+    linkbot.invite_resolver = stand_in_resolver(invites, linkbot.INVITE_BATCH_DELAY)
+    linkbot.action_queue = linkbot.ActionQueue(0, linkbot.ACTION_CONCURRENCY)
+    
+    channels = [FakeChannel(api, 2000 + i, guild) for i in range(10)]
+    members = [FakeMember(api, 10**17 + i, guild) for i in range(200)]
+    messages = []
+    expected = 0
+    for i in range(count):
+        codes = rng.choice((own, own, own, other, invalid))
+        expected += codes is not own
+        content = f"come hang out discord.gg/{rng.choice(codes)}"
+        messages.append(FakeMessage(api, i, content, members[i % len(members)], channels[i % len(channels)]))
+    
+    deleted_before = linkbot.metrics.counters['messages_deleted']
+    start = time.perf_counter()
+    # The whole raid arrives at once, so every message waits on the same batch
+    await asyncio.gather(*(linkbot.on_message(message) for message in messages))
+    while linkbot.action_queue.tasks:
+        await asyncio.gather(*list(linkbot.action_queue.tasks.values()))
+    elapsed = time.perf_counter() - start
+    deleted = linkbot.metrics.counters['messages_deleted'] - deleted_before
+    return {
+        "messages": count,
+        "distinct_codes": len(own) + len(other) + len(invalid),
+        "fetches": api.calls['fetch_invite'],
+        "deleted": deleted,
+        "expected_deleted": expected,
+        "seconds": elapsed,
+    }
+
+def bench_invites(count=5_000, latency=0.05):
+    """Push an invite raid through on_message against a stand-in invite API"""
+    with moderation_only():
+        result = asyncio.run(bench_invites_async(count, latency))
+    print(f"Invite raid: {result['messages']:,} messages, {result['distinct_codes']} distinct codes")
+    print(f"Invite fetches: {result['fetches']} (one per code), "
+          f"deleted {result['deleted']:,} of {result['expected_deleted']:,} foreign or invalid invites "
+          f"({result['seconds'] * 1000:.0f} ms)")
+    return result
+
+def legacy_log_embed(violation):
+    """Original log embed, built field by field"""
+    message = violation.message
+    embed = discord.Embed(title="🔗 Link Deleted", color=discord.Color.red(), timestamp=datetime.utcnow())
+    embed.add_field(name="👤 User", value=f"{message.author.mention}\n`{message.author.name}`\nID: `{message.author.id}`", inline=False)
+    if message.content:
+        embed.add_field(name="📝 Message Content", value=f"```{linkbot.truncate(message.content, 500)}```", inline=False)
+    embed.add_field(name="🔗 Detected Links", value="\n".join([f"• `{match.link}`" for match in violation.links[:3]]), inline=False)
+    embed.add_field(name="📌 Channel", value=f"{message.channel.mention}", inline=True)
+    embed.add_field(name="🛡️ Action", value="Auto-Deleted", inline=True)
+    embed.add_field(name="🔒 Status", value="Not Whitelisted", inline=True)
+    return embed
+
+def legacy_dm_embed(violation):
+    """Original DM embed, built field by field"""
+    message = violation.message
+    embed = discord.Embed(
+        title="⚠️ Link Removed",
+        description=f"Your message in **{message.guild.name}** was deleted because it contained links.",
+        color=discord.Color.orange()
+    )
+    embed.add_field(name="Channel", value=f"#{message.channel.name}", inline=True)
+    embed.add_field(name="Reason", value="You are not whitelisted to post links", inline=True)
+    if message.content:
+        embed.add_field(name="Your Message", value=f"```{linkbot.truncate(message.content, 300)}```", inline=False)
+    embed.add_field(name="Request Access", value="Use `!request` in the server to ask for whitelist permission", inline=False)
+    embed.set_footer(text="Only whitelisted users can post links")
+    return embed
+
+def without_timestamp(embed):
+    data = embed.to_dict()
+    data.pop('timestamp', None)
+    return data
+
+def bench_embeds(count=20_000):
+    """Compare per-violation embed building from scratch against the precomputed templates"""
+    violations = build_violations(None, count, 10, 50)
+    builders = {
+        "field by field": (legacy_log_embed, legacy_dm_embed),
+        "EmbedTemplate": (linkbot.build_log_embed, linkbot.build_dm_embed),
+    }
+    # Both builders must send Discord the same payloads
+    mismatches = sum(
+        without_timestamp(legacy_log_embed(violation)) != without_timestamp(linkbot.build_log_embed(violation))
+        or legacy_dm_embed(violation).to_dict() != linkbot.build_dm_embed(violation).to_dict()
+        for violation in violations[:100]
+    )
+    print(f"Embeds for {count:,} violations (log + DM, serialized), {mismatches} payload differences")
+    results = {}
+    for name, (log_embed, dm_embed) in builders.items():
+        start = time.perf_counter()
+        for violation in violations:
+            log_embed(violation).to_dict()
+            dm_embed(violation).to_dict()
+        elapsed = time.perf_counter() - start
+        
+        # Allocations made while building, counted on a smaller sample
+        sample = violations[:1_000]
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        embeds = [(log_embed(violation), dm_embed(violation)) for violation in sample]
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        blocks = sum(stat.count_diff for stat in stats) / len(sample)
+        size = sum(stat.size_diff for stat in stats) / len(sample)
+        del embeds
+        
+        cost = elapsed / count * 1e6
+        print(f"{name:<24} {cost:>8.1f} us/violation  {blocks:>6.1f} blocks  {size:>8,.0f} bytes retained per violation")
+        results[name] = {"us_per_violation": cost, "blocks": blocks, "bytes": size}
+    results["payload_mismatches"] = mismatches
+    return results
+
+def legacy_wllist_embed(guild, index):
+    """Original !wllist embed: every user and role line in one field each"""
+    embed = discord.Embed(title="📋 Whitelist Status", color=discord.Color.blue())
+    users_list = [f"• Unknown User (`{user_id}`)" for user_id in index.users]
+    embed.add_field(name="👤 Whitelisted Users", value="\n".join(users_list) or "None", inline=False)
+    roles_list = []
+    for role_id in index.roles:
+        role = guild.get_role(role_id)
+        roles_list.append(f"• {role.mention} (`{role.name}`) - {len(role.members)} members")
+    embed.add_field(name="🎭 Whitelisted Roles", value="\n".join(roles_list) or "None", inline=False)
+    return embed
+
+def bench_wllist(sizes=(100, 1_000, 10_000, 100_000), members=5_000, turns=20):
+    """Compare the one-shot !wllist embed against paginated rendering"""
+    results = {}
+    print(f"!wllist over a guild of {members:,} members (users, with a tenth as many roles)")
+    for size in sizes:
+        guild = FakeGuild(1)
+        role_ids = [2 * 10**17 + i for i in range(max(1, size // 10))]
+        guild.roles = {role_id: FakeRole(role_id, guild) for role_id in role_ids}
+        guild.members = [FakeMember(None, 10**17 + i, guild, [guild.roles[role_ids[i % len(role_ids)]]])
+                         for i in range(members)]
+        entries = linkbot.empty_entries()
+        entries["whitelisted_users"] = [10**17 + i for i in range(size)]
+        entries["whitelisted_roles"] = role_ids
+        index = linkbot.PermissionIndex(linkbot.empty_entries(), entries)
+        
+        # The old embed's field is rejected by Discord past 1,024 characters
+        if size <= 1_000:
+            start = time.perf_counter()
+            embed = legacy_wllist_embed(guild, index)
+            legacy = (time.perf_counter() - start) * 1000
+            longest = max(len(field['value']) for field in embed.to_dict()['fields'])
+            legacy_text = f"one embed {legacy:>9.1f} ms (longest field {longest:,} chars)"
+        else:
+            legacy = None
+            legacy_text = "one embed  (skipped, O(roles x members))"
+        
+        linkbot.name_cache.clear()
+        pages = linkbot.WhitelistPages(FakeMember(None, 1, guild), guild, index)
+        start = time.perf_counter()
+        pages.render()
+        first = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for step in range(turns):
+            pages.page = step % pages.pages
+            pages.render()
+        per_page = (time.perf_counter() - start) / turns * 1000
+        print(f"{size:>8,} entries  {legacy_text}  first page {first:>7.2f} ms  "
+              f"next pages {per_page:>6.2f} ms  ({pages.pages:,} pages)")
+        results[str(size)] = {"legacy_ms": legacy, "first_page_ms": first, "page_ms": per_page}
+    return results
+
+class FakeContext:
+    def __init__(self, guild, author=None, channel=None):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+
+    async def send(self, content=None, **kwargs):
+        await self.channel.send(content, **kwargs)
+
+async def bench_bulk_async(entries, targets, rate, latency):
+    rng = random.Random(0)
+    guild_id = 1
+    existing = rng.sample(range(10**17, 10**18), entries)
+    new_ids = rng.sample(range(10**16, 10**17), targets)
+    writes = Counter()
+    write = linkbot.storage.write
+    
+    def counted_write(changes, snapshot):
+        writes["writes"] += 1
+        write(changes, snapshot)
+    
+    def reset():
+        data = {"whitelisted_users": [], "whitelisted_roles": [], "guilds": {}}
+        data["guilds"][str(guild_id)] = dict(linkbot.empty_entries(), whitelisted_users=list(existing))
+        linkbot.bot.whitelist_data = data
+        linkbot.bot.permission_indexes = {}
+        writes.clear()
+    
+    async def legacy():
+        # One !wladd per member, each rewriting the whole file
+        for user_id in new_ids:
+            linkbot.set_whitelisted(guild_id, "users", user_id, True)
+            legacy_save_data(linkbot.bot.whitelist_data)
+            writes["writes"] += 1
+    
+    async def single():
+        for user_id in new_ids:
+            linkbot.set_whitelisted(guild_id, "users", user_id, True)
+        await linkbot.data_writer.task
+    
+    async def bulk():
+        linkbot.set_whitelisted_many(guild_id, [("users", user_id) for user_id in new_ids], True)
+        await linkbot.data_writer.task
+    
+    results = {}
+    linkbot.storage.write = counted_write
+    print(f"Bulk whitelist: {targets:,} new users in a guild with {entries:,}")
+    for name, work in (("!wladd + save_data each", legacy), ("set_whitelisted each", single),
+                       ("set_whitelisted_many", bulk)):
+        reset()
+        start = time.perf_counter()
+        await work()
+        elapsed = time.perf_counter() - start
+        print(f"{name:<24} {elapsed * 1000:>9.1f} ms  {writes['writes']:>4} writes")
+        results[name] = {"ms": elapsed * 1000, "writes": writes["writes"]}
+    linkbot.storage.write = write
+    
+    # Resolving raw IDs that aren't cached needs one fetch_user each
+    api = FakeAPI(rate, latency)
+    
+    async def fetch_user(user_id):
+        await api.call('fetch_user')
+        return FakeMember(api, user_id, None)
+    
+    fetch_user_before, get_user_before = linkbot.bot.fetch_user, linkbot.bot.get_user
+    linkbot.bot.fetch_user = fetch_user
+    linkbot.bot.get_user = lambda user_id: None
+    start = time.perf_counter()
+    for user_id in new_ids:
+        await linkbot.bot.fetch_user(user_id)
+    one_by_one = time.perf_counter() - start
+    start = time.perf_counter()
+    resolved, failed = await linkbot.resolve_targets(FakeContext(None), [(None, str(user_id)) for user_id in new_ids])
+    concurrent = time.perf_counter() - start
+    linkbot.bot.fetch_user, linkbot.bot.get_user = fetch_user_before, get_user_before
+    print(f"Resolving {targets:,} IDs ({rate} req/s, {latency * 1000:.0f} ms latency): "
+          f"one by one {one_by_one:.2f} s, resolve_targets {concurrent:.2f} s ({len(resolved):,} resolved)")
+    results["resolve_s"] = {"one_by_one": one_by_one, "concurrent": concurrent}
+    return results
+
+def bench_bulk(entries=10_000, targets=500, rate=100, latency=0.02):
+    """Compare onboarding members one command at a time against one bulk command"""
+    with tempfile.TemporaryDirectory() as tmp:
+        linkbot.DATA_FILE = os.path.join(tmp, 'whitelist_data.json')
+        linkbot.data_writer.delay = 0.05
+        return asyncio.run(bench_bulk_async(entries, targets, rate, latency))
+
+async def bench_expiry_async(grants, due):
+    rng = random.Random(0)
+    guild_id = 1
+    now = int(time.time())
+    user_ids = rng.sample(range(10**17, 10**18), grants)
+    due_ids = set(rng.sample(user_ids, due))
+    entries = linkbot.empty_entries()
+    entries["whitelisted_users"] = list(user_ids)
+    entries["grant_expiries"] = [["users", user_id, now - 1 if user_id in due_ids else now + rng.randrange(3600, 86400)]
+                                 for user_id in user_ids]
+    linkbot.bot.whitelist_data = {**linkbot.empty_entries(), "guilds": {str(guild_id): entries}}
+    linkbot.bot.permission_indexes = {}
+    scheduler = linkbot.expiry_scheduler
+    scheduler.clear()
+    results = {}
+    
+    start = time.perf_counter()
+    scheduler.load(guild_id, entries)
+    loaded = time.perf_counter() - start
+    print(f"Grant expiry with {grants:,} time-limited grants, {due:,} due at once")
+    print(f"{'rebuild heap at startup':<28} {loaded * 1000:>9.1f} ms")
+    results["load_ms"] = loaded * 1000
+    
+    # What a polling loop would pay every tick just to find nothing due
+    start = time.perf_counter()
+    sum(1 for kind, target_id, deadline in entries["grant_expiries"] if deadline <= now - 2)
+    tick = time.perf_counter() - start
+    print(f"{'polling scan (per tick)':<28} {tick * 1000:>9.1f} ms  (the scheduler sleeps instead)")
+    results["poll_tick_ms"] = tick * 1000
+    
+    expired_before = linkbot.metrics.counters['grants_expired']
+    start = time.perf_counter()
+    scheduler.start()
+    while linkbot.metrics.counters['grants_expired'] - expired_before < due:
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    remaining = len(linkbot.get_permission_index(guild_id).users)
+    print(f"{'expire the due batch':<28} {elapsed * 1000:>9.1f} ms  ({remaining:,} grants left, next in "
+          f"{scheduler.heap[0][0] - time.time():,.0f} s)")
+    results["expire_batch_ms"] = elapsed * 1000
+    scheduler.task.cancel()
+    scheduler.clear()
+    await linkbot.data_writer.task
+    return results
+
+def bench_expiry(grants=100_000, due=10_000):
+    """Time rebuilding and draining the grant expiry heap"""
+    with tempfile.TemporaryDirectory() as tmp:
+        linkbot.DATA_FILE = os.path.join(tmp, 'whitelist_data.json')
+        linkbot.data_writer.delay = 0.05
+        return asyncio.run(bench_expiry_async(grants, due))
+
+class FakeOwner(FakeMember):
+    async def send(self, content=None, **kwargs):
+        await self.api.call('owner_dm')
+
+async def legacy_request(ctx, owner, reason):
+    """Original !request: one owner DM per call, then confirmations"""
+    await owner.send(embed=discord.Embed(title="🔔 Whitelist Request", description=reason))
+    await ctx.send(embed=discord.Embed(title="✅ Request Sent"), delete_after=30)
+    await ctx.author.send(embed=discord.Embed(title="📨 Whitelist Request Submitted"))
+
+async def bench_requests_async(calls, users, spread):
+    rng = random.Random(0)
+    results = {}
+    get_user_before, queue_before = linkbot.bot.get_user, linkbot.request_queue
+    print(f"!request spam: {calls:,} calls from {users} users over {spread:.1f} s")
+    for name in ("owner DM per request", "RequestQueue digest"):
+        api = FakeAPI(1_000, 0.0)
+        guild = FakeGuild(1)
+        channel = FakeChannel(api, 1000, guild)
+        members = [FakeMember(api, 10**17 + i, guild) for i in range(users)]
+        owner = FakeOwner(api, linkbot.OWNER_ID, None)
+        linkbot.bot.get_user = lambda user_id: owner
+        linkbot.bot.whitelist_data = {**linkbot.empty_entries(), "guilds": {}}
+        linkbot.bot.permission_indexes = {}
+        linkbot.decision_cache.clear()
+        queue = linkbot.request_queue = linkbot.RequestQueue(linkbot.REQUEST_COOLDOWN, spread)
+        
+        for _ in range(calls):
+            ctx = FakeContext(guild, rng.choice(members), channel)
+            if name == "owner DM per request":
+                await legacy_request(ctx, owner, "let me post links")
+            else:
+                await linkbot.request_whitelist(ctx, reason="let me post links")
+            await asyncio.sleep(spread / calls)
+        for task in (queue.task, linkbot.data_writer.task):
+            if task:
+                await task
+        print(f"{name:<24} {api.calls['owner_dm']:>6} owner DMs  {sum(api.calls.values()):>6} API calls  "
+              f"{len(queue.pending):>4} pending")
+        results[name] = {"owner_dms": api.calls['owner_dm'], "api_calls": sum(api.calls.values())}
+    linkbot.bot.get_user, linkbot.request_queue = get_user_before, queue_before
+    return results
+
+def bench_requests(calls=1_000, users=100, spread=1.0):
+    """Compare owner DMs for a burst of repeated !request calls"""
+    with tempfile.TemporaryDirectory() as tmp:
+        linkbot.DATA_FILE = os.path.join(tmp, 'whitelist_data.json')
+        linkbot.data_writer.delay = 0.05
+        return asyncio.run(bench_requests_async(calls, users, spread))
+
+# Pieces for random adversarial text: host characters, schemes and separators
+FUZZ_TOKENS = ["a", "z", "1", "-", ".", "..", "/", " ", ":", "_", "com", "co", "www.",
+               "http://", "https://", "discord.gg/", "youtu.be/", "\n"]
+
+def time_call(func, text):
+    """Return how long func(text) takes, in seconds"""
+    start = time.perf_counter()
+    func(text)
+    return time.perf_counter() - start
+
+def bench_redos(fuzz=2_000, seed=0):
+    """Show contains_links stays linear on adversarial input, and still agrees with the old regex"""
+    rng = random.Random(seed)
+    limit = linkbot.link_detector.max_length
+    results = {}
+    
+    print("Worst-case link scanning (us per 1,000 characters)")
+    sizes = [1_000, 4_000, 16_000, limit]
+    print(f"{'shape':<12}" + "".join(f"{size:>12,}" for size in sizes) + "   growth")
+    for name, shape in NEAR_URL_SHAPES.items():
+        costs = []
+        for size in sizes:
+            text = shape(size // 2)
+            best = min(time_call(linkbot.contains_links, text) for _ in range(3))
+            costs.append(best / len(text) * 1e9)
+        # Linear scanning keeps the per-character cost flat as inputs grow
+        growth = costs[-1] / costs[0]
+        print(f"{name:<12}" + "".join(f"{cost:>12.1f}" for cost in costs) + f"   {growth:.2f}x")
+        results[name] = {"us_per_kchar": costs, "growth": growth}
+    
+    # Oversized input is cut off at the scan limit instead of scanned in full
+    text = NEAR_URL_SHAPES["dotted"](limit * 5)
+    capped = time_call(linkbot.contains_links, text)
+    print(f"{len(text):,} chars (over the {limit:,} limit): {capped * 1000:.1f} ms")
+    results["over_limit_ms"] = capped * 1000
+    
+    # Random token soup: worst time per character, and agreement with the
+    # old regex on inputs short enough for it to finish quickly
+    worst = 0.0
+    mismatches = 0
+    legacy = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern in LEGACY_LINK_PATTERNS.items()), re.IGNORECASE)
+    for _ in range(fuzz):
+        text = "".join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randrange(1, 2_000)))
+        worst = max(worst, time_call(linkbot.contains_links, text) / len(text))
+        short = text[:rng.randrange(1, 40)]
+        expected = [(m.lastgroup, m.start(), m.end()) for m in legacy.finditer(short)] if "." in short else []
+        if list(linkbot.link_detector.finditer(short)) != expected:
+            mismatches += 1
+    print(f"Fuzzed {fuzz:,} inputs: worst {worst * 1e9:.1f} us per 1,000 chars, {mismatches} disagreements with the old regex")
+    results["fuzz_worst_us_per_kchar"] = worst * 1e9
+    results["fuzz_mismatches"] = mismatches
+    return results
+
+@contextlib.contextmanager
+def launched_environment(env, directory):
+    """Start child processes the way launch_processes would, in a scratch directory"""
+    saved, cwd = dict(os.environ), os.getcwd()
+    os.environ.clear()
+    os.environ.update(env)
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        os.chdir(cwd)
+
+async def shared_writer(guild, user_ids, pace):
+    """Whitelist each user with !wladd, as the owner would in this process's shards"""
+    written = {}
+    api = FakeAPI(rate=10**6, latency=0)
+    owner = FakeMember(api, linkbot.OWNER_ID, guild)
+    members = {user_id: FakeMember(api, user_id, guild) for user_id in user_ids}
+    linkbot.bot.get_user = members.get
+    ctx = FakeContext(guild, owner, FakeChannel(api, 1000, guild))
+    ctx.bot, ctx._state = linkbot.bot, linkbot.bot._connection
+    for user_id in user_ids:
+        await linkbot.prepare_command(ctx)
+        await linkbot.whitelist_add.callback(ctx, f"<@{user_id}>")
+        written[user_id] = time.time()
+        await asyncio.sleep(pace)
+    await linkbot.data_writer.task
+    return written
+
+async def shared_peer(guild, user_ids, interval, ready, done):
+    """Watch the ChangeFeed deliver the writer's grants to is_allowed and on_message"""
+    seen = {"allowed": {}}
+    api = FakeAPI(rate=10**6, latency=0)
+    flagged = set()
+    linkbot.action_queue.submit = lambda message, links: flagged.add(message.author.id)
+    members = {user_id: FakeMember(api, user_id, guild) for user_id in user_ids}
+    channel = FakeChannel(api, 1000, guild)
+    
+    async def post(member):
+        await linkbot.on_message(FakeMessage(api, 0, f"see https://shared{member.id}.example.com", member, channel))
+        return member.id not in flagged
+    
+    # Polls with nothing new are what every process pays between changes
+    start = time.perf_counter()
+    for _ in range(1_000):
+        linkbot.storage.read_changes()
+    seen["idle_poll_us"] = (time.perf_counter() - start) / 1_000 * 1e6
+    seen["posted_before"] = sum([await post(member) for member in members.values()])
+    flagged.clear()
+    
+    linkbot.change_feed.interval = interval
+    linkbot.change_feed.start()
+    ready.set()
+    pending = dict(members)
+    deadline = None
+    while pending:
+        for user_id, member in list(pending.items()):
+            if linkbot.is_allowed(member):
+                seen["allowed"][user_id] = time.time()
+                del pending[user_id]
+        if done.is_set():
+            # The writer flushed its last batch; give the feed two polls to catch up
+            deadline = deadline or time.monotonic() + 2 * interval + 1
+            if time.monotonic() > deadline:
+                break
+        await asyncio.sleep(0.001)
+    seen["posted_after"] = sum([await post(member) for member in members.values()])
+    return seen
+
+def shared_process(role, user_ids, pace, interval, ready, done, results):
+    """One bot process of the pair, with the storage and shards its environment gives it"""
+    guild = FakeGuild(1)
+    report = {"shards": linkbot.SHARD_IDS, "storage": type(linkbot.storage).__name__,
+              "publish": linkbot.storage.publish}
+    
+    async def main():
+        await linkbot.load_guild(guild.id)
+        if role == "writer":
+            ready.wait()
+            report["granted"] = await shared_writer(guild, user_ids, pace)
+            done.set()
+        else:
+            report.update(await shared_peer(guild, user_ids, interval, ready, done))
+    
+    with moderation_only():
+        asyncio.run(main())
+    results.put((role, report))
+
+def bench_shared(changes=200, pace=0.005, intervals=(0.05, 0.25, 1.0), shards=4):
+    """Time how long !wladd in one bot process takes to change decisions in another"""
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    environments = linkbot.shard_environments(shards, 2)
+    assigned = sorted(int(shard) for env in environments for shard in env["LINKBOT_SHARD_IDS"].split(","))
+    assert assigned == list(range(shards))
+    user_ids = [10**17 + n for n in range(changes)]
+    print(f"Propagation of {changes} !wladd changes between two processes running "
+          f"shards {' and '.join(env['LINKBOT_SHARD_IDS'] for env in environments)} of {shards} "
+          f"(save delay {linkbot.SAVE_DELAY:.1f} s)")
+    for interval in intervals:
+        with tempfile.TemporaryDirectory() as tmp:
+            ready, done, queue = context.Event(), context.Event(), context.Queue()
+            processes = []
+            for env, role in zip(environments, ("writer", "peer")):
+                process = context.Process(target=shared_process,
+                                          args=(role, user_ids, pace, interval, ready, done, queue))
+                with launched_environment(env, tmp):
+                    process.start()
+                processes.append(process)
+            reports = dict(queue.get() for _ in processes)
+            for process in processes:
+                process.join()
+        written, seen = reports["writer"]["granted"], reports["peer"]
+        for report in reports.values():
+            assert report["storage"] == "SqliteBackend" and report["publish"]
+        
+        flipped = [user_id for user_id in user_ids if user_id in seen["allowed"]]
+        delays = sorted(seen["allowed"][user_id] - written[user_id] for user_id in flipped)
+        assert seen["posted_before"] == 0, "peer let links through before any !wladd"
+        assert len(flipped) == changes, f"only {len(flipped)}/{changes} grants reached the peer"
+        assert seen["posted_after"] == changes, "peer still deletes links from granted users"
+        row = {
+            "idle_poll_us": seen["idle_poll_us"],
+            "p50_ms": percentile(delays, 0.5) * 1000,
+            "max_ms": delays[-1] * 1000,
+            "applied": len(flipped),
+        }
+        print(f"poll every {interval * 1000:>5.0f} ms  idle poll {row['idle_poll_us']:>6.1f} us  "
+              f"delay p50 {row['p50_ms']:>7.1f} ms  max {row['max_ms']:>7.1f} ms  "
+              f"{len(flipped)}/{changes} allowed, {seen['posted_after']} links kept")
+        results[f"{interval}s"] = row
+    return results
+
+SUITES = {
+    "detection": bench_detection,
+    "persistence": bench_persistence,
+    "actions": bench_actions,
+    "replay": bench_replay,
+    "redos": bench_redos,
+    "scanning": bench_scanning,
+    "domains": bench_domains,
+    "invites": bench_invites,
+    "flood": bench_flood,
+    "raid": bench_raid,
+    "embeds": bench_embeds,
+    "wllist": bench_wllist,
+    "bulk": bench_bulk,
+    "expiry": bench_expiry,
+    "requests": bench_requests,
+    "shared": bench_shared,
+}
+
+def compare(previous, current):
+    """Print throughput ratios for replay scenarios present in both runs"""
+    before = previous.get("results", {}).get("replay", {})
+    after = current["results"].get("replay", {})
+    print(f"Compared with {previous.get('version', 'previous run')}")
+    for name, result in after.items():
+        if name in before:
+            ratio = result["msg_per_s"] / before[name]["msg_per_s"]
+            print(f"{name:<14} {ratio:>6.2f}x msg/s  p99 {before[name]['p99_us']:.1f} -> {result['p99_us']:.1f} us")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES),
+                        help="suite to run (repeatable, default: all)")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="replay scenario to run (repeatable, default: all)")
+    parser.add_argument('--corpus', help="recorded corpus to replay (JSON list or one message per line)")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply replay corpus sizes")
+    parser.add_argument('--version', default='dev', help="label stored with the results")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="earlier JSON results to compare replay throughput with")
+    args = parser.parse_args(argv)
+    
+    results = {}
+    for name in args.suite or SUITES:
+        if name == "replay":
+            results[name] = bench_replay(args.scenario, args.corpus, args.scale)
+        else:
+            results[name] = SUITES[name]()
+        print()
+    
+    run_info = {
+        "version": args.version,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run_info, f, indent=4)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), run_info)
+
+if __name__ == "__main__":
+    main()
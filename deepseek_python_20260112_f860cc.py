@@ -1,174 +1,2295 @@
 import discord
 from discord.ext import commands
 import re
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 import json
 import os
+import sys
+import io
+import csv
+import time
+import bisect
+import heapq
+import sqlite3
+import subprocess
+import threading
+from array import array
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
-
 # Configuration
-OWNER_ID = YOUR_OWNER_ID_HERE  # Replace with your Discord ID
-TOKEN = 'YOUR_BOT_TOKEN_HERE'  # Replace with your bot token
+OWNER_ID = int(os.environ.get('LINKBOT_OWNER_ID', 0))  # Your Discord ID (set LINKBOT_OWNER_ID or replace 0)
+TOKEN = os.environ.get('LINKBOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')  # Your bot token (set LINKBOT_TOKEN or replace the placeholder)
 DATA_FILE = 'whitelist_data.json'  # File to store whitelist data
+STORAGE_BACKEND = 'json'  # 'json' rewrites DATA_FILE, 'journal' appends to JOURNAL_FILE, 'sqlite' uses DATABASE_FILE
+JOURNAL_FILE = 'whitelist_data.journal'  # Change journal for the 'journal' backend
+DATABASE_FILE = 'whitelist_data.db'  # Database for the 'sqlite' backend (imports DATA_FILE on first run)
+GLOBAL_GUILD_ID = 0  # Scope for entries that apply in every guild
+JOURNAL_COMPACT_AFTER = 1000  # Journal records before compacting into DATA_FILE
+SAVE_CHUNK_SIZE = 5000  # List items per C-encoder call when saving DATA_FILE (bounds event loop stalls)
+SAVE_DELAY = 1.0  # Seconds to coalesce whitelist changes into one write
+ACTION_BATCH_DELAY = 0.5  # Seconds to gather violations in a channel before acting
+ACTION_CONCURRENCY = 4  # Channels (and DMs) handled at once by the action queue
+BROADCAST_CONCURRENCY = 5  # DMs in flight at once during !wldm
+BROADCAST_RETRIES = 3  # Extra attempts per DM after a failed send
+BROADCAST_PROGRESS_INTERVAL = 5.0  # Seconds between !wldm progress updates
+CLEAN_MAX_MESSAGES = 5000  # Most messages !clean will scan in one run
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)  # Discord's bulk delete window, with margin
+SWEEP_CONCURRENCY = 5  # Channels scanned at once by !cleanserver
+SWEEP_PROGRESS_INTERVAL = 3.0  # Seconds between !cleanserver status updates
+METRICS_HOST = '127.0.0.1'  # Interface for the Prometheus metrics endpoint
+METRICS_PORT = 9108  # Port for the Prometheus metrics endpoint (0 disables it); sharded processes add their first shard ID
+METRIC_COUNTERS = ('messages_seen', 'links_found', 'messages_deleted', 'dm_failures', 'invite_fetches', 'timeouts',
+                   'duplicate_spam', 'grants_expired', 'remote_changes')
+PERMISSION_CACHE_SIZE = 10000  # Max cached allow/deny decisions
+PERMISSION_CACHE_TTL = 300  # Seconds before a cached decision is recomputed
+ALLOWED_INVITE_GUILDS = []  # Guild IDs anyone may post invites to (a server's own invites always pass)
+INVITE_CACHE_SIZE = 5000  # Max cached invite code -> guild lookups
+INVITE_CACHE_TTL = 3600  # Seconds before a resolved invite is fetched again
+INVITE_NEGATIVE_TTL = 300  # Seconds an invalid invite code stays cached
+INVITE_BATCH_DELAY = 0.2  # Seconds to gather invite codes into one batch of fetches
+INVITE_FETCH_CONCURRENCY = 3  # Invite fetches in flight at once
+INVITE_CODES_PER_MESSAGE = 5  # Uncached invite codes fetched per message; any more count as foreign
+VIOLATION_THRESHOLD = 5  # Violations within VIOLATION_WINDOW before a member is timed out
+VIOLATION_WINDOW = 60  # Seconds of violations counted per member
+VIOLATION_TRACKER_SIZE = 10000  # Members whose recent violations are remembered
+TIMEOUT_DURATION = timedelta(minutes=10)  # Timeout given to members over the threshold
+FINGERPRINT_CACHE_SIZE = 5000  # Recently flagged message payloads remembered per bot
+FINGERPRINT_TTL = 300  # Seconds a flagged payload is deleted on sight
+RAID_THRESHOLD = 10  # Copies of flagged payloads within RAID_WINDOW that start raid mode
+RAID_WINDOW = 30  # Seconds of copies counted; raid mode ends after this long without violations
+RAID_SUMMARY_INTERVAL = 5.0  # Seconds between raid summary updates
+MAX_SCAN_LENGTH = 100000  # Characters of a single text scanned for links; the rest is ignored
+SCAN_OFFLOAD_THRESHOLD = 2000  # Texts at least this long are scanned in a worker process
+SCAN_WORKERS = 2  # Worker processes for large scans
+SCAN_QUEUE_SIZE = 50  # Large scans queued or running at once; further ones wait
+SCAN_ATTACHMENTS = True  # Also scan text attachments and embed URLs
+ATTACHMENT_SCAN_MAX_BYTES = 100000  # Larger attachments are not downloaded or scanned
+TEXT_ATTACHMENT_EXTENSIONS = ('.txt', '.log', '.md', '.csv', '.json', '.html', '.xml', '.yml', '.yaml', '.ini', '.cfg')
+WLLIST_PAGE_SIZE = 10  # Users or roles shown per !wllist page
+WLLIST_TIMEOUT = 180  # Seconds the !wllist page buttons stay active
+WLLIST_NAME_LENGTH = 40  # Characters of a role name shown on !wllist, so a full page fits one embed field
+NAME_CACHE_SIZE = 10000  # Rendered user and role lines kept for !wllist
+NAME_CACHE_TTL = 600  # Seconds before a cached name or member count is looked up again
+BULK_MAX_TARGETS = 5000  # Users and roles accepted by one !wlbulkadd or !wlbulkremove
+BULK_IMPORT_MAX_BYTES = 1000000  # Larger import files are refused
+BULK_RESOLVE_CONCURRENCY = 10  # User lookups in flight at once while resolving bulk targets
+MAX_GRANT_DURATION = 5 * 365 * 86400  # Longest !wltemp grant, in seconds
+REQUEST_COOLDOWN = 3600  # Seconds before a user can send another !request
+REQUEST_DIGEST_INTERVAL = 300  # Seconds of new requests collected into one owner DM
+REQUEST_REASON_LIMIT = 500  # Characters of a request reason that are kept
+SHARD_COUNT = int(os.environ.get('LINKBOT_SHARD_COUNT', 0))  # Total gateway shards (0 runs one unsharded bot)
+SHARD_IDS = [int(shard) for shard in os.environ.get('LINKBOT_SHARD_IDS', '').split(',') if shard]  # Shards this process runs (empty runs all)
+SHARD_PROCESSES = int(os.environ.get('LINKBOT_SHARD_PROCESSES', 1))  # Processes the launcher splits SHARD_COUNT shards across
+CHANGE_POLL_INTERVAL = 1.0  # Seconds between checks for whitelist changes made by other processes
+CHANGE_LOG_RETENTION = 3600  # Seconds shared change records are kept for other processes
+
+# Sharded processes each run SHARD_IDS of SHARD_COUNT shards; !help is our own command
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents, help_command=None,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, help_command=None)
+
+# Link patterns (category -> pattern)
+LINK_PATTERNS = {
+    'invite': r'(https?://)?(www\.)?(discord\.(gg|io|me|li)|discordapp\.com/invite)/[a-zA-Z0-9]+',  # Discord invites
+    'youtube': r'(https?://)?(www\.)?(youtube\.com|youtu\.be)/[^\s]+'  # YouTube links
+}
+
+# Every invite and YouTube link has one of these keywords, at most
+# len("https://www.") characters after the start of the link
+LINK_KEYWORDS = re.compile(r'[dy](?:iscord|outu)', re.IGNORECASE)
+LINK_KEYWORD_OFFSET = len('https://www.')
+
+# General URLs are everything matching
+#   (https?://)?(www\.)?([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}(/\S*)?
+# As a regex that backtracks quadratically on runs like "a.a.a.a...1",
+# so scan_url() matches the same text with a single linear pass instead.
+URL_CATEGORY = 'url'
+
+# A run of host characters that contains at least one dot. The lookbehind
+# stops the regex from retrying at every position inside a dotless word.
+HOST_RUN = re.compile(r'(?<![a-zA-Z0-9-])[a-zA-Z0-9-]*\.[a-zA-Z0-9.-]*')
+HOST_CHARS = re.compile(r'[a-zA-Z0-9.-]+')
+URL_PATH = re.compile(r'/\S*')
+URL_SCHEMES = ('https://', 'http://')
+
+def find_host(text, start, end):
+    """Return the span of the first host name in text[start:end], or None"""
+    # Labels are split on dots; an empty label (leading, trailing or doubled
+    # dot) ends the chain. The top-level domain is the last label in the chain
+    # after the first that starts with two letters, like the greedy regex.
+    chain_start = None
+    host_end = None
+    i = start
+    while i <= end:
+        dot = text.find('.', i, end)
+        if dot == -1:
+            dot = end
+        if i == dot:
+            if host_end is not None:
+                return chain_start, host_end
+            chain_start = None
+        elif chain_start is None:
+            chain_start = i
+        elif dot - i >= 2 and text[i].isalpha() and text[i + 1].isalpha():
+            host_end = i + 2
+            while host_end < dot and text[host_end].isalpha():
+                host_end += 1
+        i = dot + 1
+    if host_end is not None:
+        return chain_start, host_end
+    return None
+
+def scan_url(text, pos=0):
+    """Return the span of the first general URL in text at or after pos, or None"""
+    # A previous link may have ended part way through a run of host characters
+    run = HOST_CHARS.match(text, pos) if pos else None
+    if run is None or '.' not in run.group():
+        run = HOST_RUN.search(text, run.end() if run else pos)
+    while run is not None:
+        host = find_host(text, run.start(), run.end())
+        if host is not None:
+            break
+        run = HOST_RUN.search(text, run.end())
+    else:
+        return None
+    start, end = host
+    for scheme in URL_SCHEMES:
+        if start - len(scheme) >= pos and text[start - len(scheme):start].lower() == scheme:
+            start -= len(scheme)
+            break
+    if text.startswith('/', end):
+        end = URL_PATH.match(text, end).end()
+    return start, end
+
+# A single detected link: matched text, category and span in the text it came from
+LinkMatch = namedtuple('LinkMatch', ['link', 'category', 'start', 'end'])
+
+class LinkDetector:
+    """Find links in linear time, whatever the input looks like"""
+
+    def __init__(self, patterns, max_length=MAX_SCAN_LENGTH):
+        self.categories = tuple(patterns) + (URL_CATEGORY,)
+        self.max_length = max_length
+        # Invites and YouTube links in one alternation with a named group per
+        # category; neither pattern can backtrack past its fixed prefix
+        self.regex = re.compile(
+            '|'.join(f'(?P<{name}>{pattern})' for name, pattern in patterns.items()),
+            re.IGNORECASE
+        )
+
+    def search(self, text, pos=0):
+        """Return the first invite or YouTube match at or after pos, or None"""
+        # Both need a keyword a few characters in, so try the full patterns
+        # only just before each keyword instead of at every position
+        for keyword in LINK_KEYWORDS.finditer(text, pos):
+            for start in range(max(pos, keyword.start() - LINK_KEYWORD_OFFSET), keyword.start() + 1):
+                match = self.regex.match(text, start)
+                if match:
+                    return match
+        return None
+
+    def finditer(self, text):
+        """Yield (category, start, end) for every link in text, left to right"""
+        # Every category needs a literal dot, so plain chat skips the scan entirely
+        if not text or '.' not in text:
+            return
+        text = text[:self.max_length]
+        special = self.search(text)
+        url = scan_url(text)
+        while special is not None or url is not None:
+            # Leftmost link wins; on a tie the specific categories go first
+            if special is not None and (url is None or special.start() <= url[0]):
+                category, start, end = special.lastgroup, special.start(), special.end()
+            else:
+                category, (start, end) = URL_CATEGORY, url
+            yield category, start, end
+            # Only search again for a candidate the emitted link overlapped
+            if special is not None and special.start() < end:
+                special = self.search(text, end)
+            if url is not None and url[0] < end:
+                url = scan_url(text, end)
+
+    def detect(self, text):
+        """Return the category of the first link in text, or None"""
+        for category, start, end in self.finditer(text):
+            return category
+        return None
+
+    def extract(self, text):
+        """Return every distinct link in text as LinkMatch tuples, in order"""
+        found = {}
+        for category, start, end in self.finditer(text):
+            link = text[start:end]
+            if link not in found:
+                found[link] = LinkMatch(link, category, start, end)
+        return list(found.values())
+
+link_detector = LinkDetector(LINK_PATTERNS)
+
+# Metrics
+# Stage timings go into fixed-size log-bucketed histograms, so memory stays
+# constant no matter how many messages the bot sees.
+
+class Histogram:
+    """Latency histogram (seconds) with fixed log-scale buckets"""
+    # Upper bounds from 10 µs to 100 s, ten buckets per decade
+    BOUNDS = tuple(10 ** (exponent / 10) for exponent in range(-50, 21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples"""
+        rank = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.BOUNDS[min(position, len(self.BOUNDS) - 1)]
+        return 0.0
+
+class Timer:
+    """Context manager that records its elapsed time into a histogram"""
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
 
-# Link patterns
-LINK_PATTERNS = [
-    r'(https?://)?(www\.)?(discord\.(gg|io|me|li)|discordapp\.com/invite)/[a-zA-Z0-9]+',  # Discord invites
-    r'(https?://)?(www\.)?(youtube\.com|youtu\.be)/[^\s]+',  # YouTube links
-    r'(https?://)?(www\.)?([a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}(/\S*)?'  # General URLs
-]
+class Metrics:
+    """Named stage histograms and event counters"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = dict.fromkeys(METRIC_COUNTERS, 0)
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        return histogram
+
+    def timer(self, stage):
+        return Timer(self.histogram(stage))
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def prometheus(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE linkblocker_{name}_total counter")
+            lines.append(f"linkblocker_{name}_total {value}")
+        lines.append("# TYPE linkblocker_permission_cache_hits_total counter")
+        lines.append(f"linkblocker_permission_cache_hits_total {decision_cache.hits}")
+        lines.append("# TYPE linkblocker_permission_cache_misses_total counter")
+        lines.append(f"linkblocker_permission_cache_misses_total {decision_cache.misses}")
+        lines.append("# TYPE linkblocker_stage_seconds histogram")
+        for stage, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(Histogram.BOUNDS, histogram.counts):
+                cumulative += count
+                lines.append(f'linkblocker_stage_seconds_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'linkblocker_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'linkblocker_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'linkblocker_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request on the metrics port with the Prometheus text"""
+    try:
+        request_line = await reader.readline()
+        # Drain the request headers
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[1].split('?')[0] in ('/', '/metrics'):
+            status = "200 OK"
+            body = metrics.prometheus().encode()
+        else:
+            status = "404 Not Found"
+            body = b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"Metrics error: {e}")
+    finally:
+        writer.close()
 
 # Load whitelist data
-def load_data():
+# Top-level lists hold global entries that apply in every guild (this is the
+# original file format); per-guild entries live under "guilds" by guild ID.
+# Change record kind -> list it edits in a scope's entries
+ENTRY_KEYS = {
+    "users": "whitelisted_users",
+    "roles": "whitelisted_roles",
+    "allowed": "allowed_domains",
+    "blocked": "blocked_domains",
+    "expiries": "grant_expiries",
+    "requests": "pending_requests",
+}
+DOMAIN_KINDS = ("allowed", "blocked")
+# Expiry entries are [kind, target_id, deadline] records for time-limited
+# grants; the granted ID itself is an ordinary users/roles entry. Request
+# entries are [user_id, requested_at, channel_id, reason, count] records of
+# pending !request calls, timed by the latest one.
+
+def entry_key(target):
+    """Hashable form of an entry (expiry records are lists)"""
+    return tuple(target) if isinstance(target, list) else target
+
+def empty_entries():
+    return {key: [] for key in ENTRY_KEYS.values()}
+
+def read_snapshot():
+    data = empty_entries()
+    data["guilds"] = {}
     if os.path.exists(DATA_FILE):
         with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {"whitelisted_users": [], "whitelisted_roles": []}
+            data.update(json.load(f))
+    # Files from before domain rules lack those lists
+    for entries in (data, *data["guilds"].values()):
+        for key in ENTRY_KEYS.values():
+            entries.setdefault(key, [])
+    return data
+
+def encode_json(data):
+    """Yield data as compact JSON, encoding long lists a slice at a time
+
+    json.dump and indent use the pure-Python encoder; json.dumps without
+    indent runs the much faster C one, but holds the GIL for the whole
+    call. Slices keep each hold short so the event loop keeps running.
+    """
+    if isinstance(data, dict):
+        yield "{"
+        for n, (key, value) in enumerate(data.items()):
+            yield ("," if n else "") + json.dumps(str(key)) + ":"
+            yield from encode_json(value)
+        yield "}"
+    elif isinstance(data, list) and len(data) > SAVE_CHUNK_SIZE:
+        yield "["
+        for start in range(0, len(data), SAVE_CHUNK_SIZE):
+            yield ("," if start else "") + json.dumps(data[start:start + SAVE_CHUNK_SIZE], separators=(',', ':'))[1:-1]
+        yield "]"
+    else:
+        yield json.dumps(data, separators=(',', ':'))
 
 def save_data(data):
-    with open(DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    """Atomically write data to DATA_FILE (temp file + fsync + rename)"""
+    temp_file = f"{DATA_FILE}.tmp"
+    with open(temp_file, 'w') as f:
+        for piece in encode_json(data):
+            f.write(piece)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, DATA_FILE)
+
+def snapshot_data(data):
+    """Copy the whitelist data so it can be serialized off the event loop"""
+    if isinstance(data, dict):
+        return {key: snapshot_data(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return list(data)
+    return data
+
+def guild_entries(data, guild_id, create=False):
+    """Return the whitelist lists of one guild (the top level for GLOBAL_GUILD_ID)"""
+    if guild_id == GLOBAL_GUILD_ID:
+        return data
+    key = str(guild_id)
+    if create and key not in data["guilds"]:
+        data["guilds"][key] = empty_entries()
+    return data["guilds"].get(key)
+
+def replay_changes(data, changes):
+    """Apply change records to data in order"""
+    # Dicts keep list order while giving O(1) membership during replay
+    replayed = {}
+    for op, guild_id, kind, target_id in changes:
+        ids = replayed.get((guild_id, kind))
+        if ids is None:
+            entries = guild_entries(data, guild_id, create=True)
+            ids = replayed[(guild_id, kind)] = {entry_key(target): target for target in entries[ENTRY_KEYS[kind]]}
+        if op == "+":
+            ids[entry_key(target_id)] = target_id
+        else:
+            ids.pop(entry_key(target_id), None)
+    for (guild_id, kind), ids in replayed.items():
+        guild_entries(data, guild_id)[ENTRY_KEYS[kind]] = list(ids.values())
+
+# Storage backends
+# A backend loads the whitelist at startup and persists batches of changes.
+# Changes are ("+" or "-", guild_id, kind, target_id) records; write() runs
+# in an executor and gets a snapshot of the full data only when
+# needs_snapshot() asked for one. Lazy backends load guilds on demand
+# through load_guild() instead of holding every guild in memory. A
+# publishing SqliteBackend also logs each change so other processes sharing
+# the database can read it back with read_changes().
+
+class JsonBackend:
+    """Rewrite the whole DATA_FILE on every save"""
+    lazy = False
+
+    def load(self):
+        return read_snapshot()
+
+    def needs_snapshot(self, change_count):
+        return True
+
+    def write(self, changes, snapshot):
+        save_data(snapshot)
+
+class JournalBackend:
+    """Append changes to a journal and periodically compact into DATA_FILE"""
+    lazy = False
+
+    def __init__(self, journal_file, compact_after):
+        self.journal_file = journal_file
+        self.compact_after = compact_after
+        self.journal_length = 0
+
+    def load(self):
+        """Replay the journal on top of the last snapshot"""
+        data = read_snapshot()
+        self.journal_length = 0
+        if not os.path.exists(self.journal_file):
+            return data
+        
+        changes = []
+        torn = False
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    torn = True  # Partial record from an interrupted append
+                    continue
+                if len(change) == 3:
+                    # Records written before per-guild whitelists were global
+                    change.insert(1, GLOBAL_GUILD_ID)
+                changes.append(change)
+        replay_changes(data, changes)
+        self.journal_length = len(changes)
+        
+        if torn:
+            # Compact on the next write so new records never follow a torn line
+            self.journal_length = self.compact_after
+        return data
+
+    def needs_snapshot(self, change_count):
+        return self.journal_length + change_count >= self.compact_after
+
+    def write(self, changes, snapshot):
+        if snapshot is not None:
+            # The snapshot already contains these changes, so compact instead
+            save_data(snapshot)
+            with open(self.journal_file, 'w') as f:
+                os.fsync(f.fileno())
+            self.journal_length = 0
+            return
+        
+        with open(self.journal_file, 'a') as f:
+            for change in changes:
+                f.write(json.dumps(change, separators=(',', ':')) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_length += len(changes)
+
+class SqliteBackend:
+    """Per-guild whitelist rows in SQLite, loaded one guild at a time"""
+    lazy = True
+
+    def __init__(self, database_file, publish=False):
+        self.database_file = database_file
+        self.publish = publish
+        self.origin = str(os.getpid())
+        self.cursor = 0  # Last change log seq this process has read
+        self.connection = None
+        # Calls arrive on executor threads; one connection, one caller at a time
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            connection = sqlite3.connect(self.database_file, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS whitelist ("
+                "guild_id INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "target_id INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, kind, target_id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS domain_rules ("
+                "guild_id INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "domain TEXT NOT NULL, "
+                "PRIMARY KEY (guild_id, kind, domain))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS grant_expiries ("
+                "guild_id INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "target_id INTEGER NOT NULL, "
+                "expires_at INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, kind, target_id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS pending_requests ("
+                "guild_id INTEGER NOT NULL, "
+                "kind TEXT NOT NULL, "
+                "user_id INTEGER NOT NULL, "
+                "requested_at INTEGER NOT NULL, "
+                "channel_id INTEGER, "
+                "reason TEXT, "
+                "count INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, user_id))"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS changes ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "origin TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "change TEXT NOT NULL)"
+            )
+            connection.commit()
+            self.connection = connection
+        return self.connection
+
+    def load(self):
+        """Open the database, importing DATA_FILE into it on first run"""
+        with self.lock:
+            connection = self.connect()
+            # user_version marks the import as done, so a whitelist emptied
+            # later isn't refilled from the old file on the next start
+            if connection.execute("PRAGMA user_version").fetchone()[0] == 0:
+                empty = all(
+                    connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+                    for table in ("whitelist", "domain_rules")
+                )
+                if empty and os.path.exists(DATA_FILE):
+                    self.migrate(read_snapshot())
+                connection.execute("PRAGMA user_version = 1")
+            # Changes logged before now are already in the rows loaded below
+            self.cursor = connection.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        
+        # Only global entries are loaded up front; guilds follow on demand
+        data = self.load_guild(GLOBAL_GUILD_ID)
+        data["guilds"] = {}
+        return data
+
+    def migrate(self, data):
+        """Copy a JSON whitelist into the database (caller holds the lock)"""
+        scopes = [(GLOBAL_GUILD_ID, data)]
+        scopes.extend((int(key), entries) for key, entries in data["guilds"].items())
+        rows = {}
+        for guild_id, entries in scopes:
+            for kind, key in ENTRY_KEYS.items():
+                rows.setdefault(self.table(kind)[0], []).extend(self.row(guild_id, kind, target) for target in entries[key])
+        with self.connection:
+            for table, table_rows in rows.items():
+                if table_rows:
+                    placeholders = ", ".join("?" * len(table_rows[0]))
+                    self.connection.executemany(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders})", table_rows)
+        count = sum(len(table_rows) for table_rows in rows.values())
+        print(f"Migrated {count} whitelist entries from {DATA_FILE} to {self.database_file}")
+
+    def table(self, kind):
+        """Table and value column holding one kind of entry"""
+        if kind in DOMAIN_KINDS:
+            return "domain_rules", "domain"
+        if kind == "expiries":
+            return "grant_expiries", "target_id"
+        if kind == "requests":
+            return "pending_requests", "user_id"
+        return "whitelist", "target_id"
+
+    def row(self, guild_id, kind, target):
+        """Column values for one entry; expiry records carry their own kind"""
+        if kind == "expiries":
+            return (guild_id, *target)
+        if kind == "requests":
+            return (guild_id, kind, *target)
+        return (guild_id, kind, target)
+
+    def load_guild(self, guild_id):
+        entries = empty_entries()
+        with self.lock:
+            connection = self.connect()
+            rows = []
+            for table, column in (self.table("users"), self.table("allowed")):
+                rows.extend(connection.execute(
+                    f"SELECT kind, {column} FROM {table} WHERE guild_id = ? ORDER BY rowid",
+                    (guild_id,)
+                ).fetchall())
+            expiries = connection.execute(
+                "SELECT kind, target_id, expires_at FROM grant_expiries WHERE guild_id = ?",
+                (guild_id,)
+            ).fetchall()
+            requests = connection.execute(
+                "SELECT user_id, requested_at, channel_id, reason, count FROM pending_requests "
+                "WHERE guild_id = ? ORDER BY requested_at",
+                (guild_id,)
+            ).fetchall()
+        for kind, target in rows:
+            entries[ENTRY_KEYS[kind]].append(target)
+        entries[ENTRY_KEYS["expiries"]] = [list(expiry) for expiry in expiries]
+        entries[ENTRY_KEYS["requests"]] = [list(request) for request in requests]
+        return entries
+
+    def needs_snapshot(self, change_count):
+        return False
+
+    def write(self, changes, snapshot):
+        # One transaction per batch
+        with self.lock, self.connect() as connection:
+            for op, guild_id, kind, target in changes:
+                table, column = self.table(kind)
+                row = self.row(guild_id, kind, target)
+                if op == "+":
+                    placeholders = ", ".join("?" * len(row))
+                    connection.execute(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders})", row)
+                else:
+                    connection.execute(
+                        f"DELETE FROM {table} WHERE guild_id = ? AND kind = ? AND {column} = ?",
+                        row[:3]
+                    )
+            if self.publish:
+                # Logged in the same transaction, so readers never see a change before its rows
+                now = time.time()
+                connection.executemany(
+                    "INSERT INTO changes (origin, created_at, change) VALUES (?, ?, ?)",
+                    [(self.origin, now, json.dumps(change, separators=(',', ':'))) for change in changes]
+                )
+                connection.execute("DELETE FROM changes WHERE created_at < ?", (now - CHANGE_LOG_RETENTION,))
+
+    def request_guilds(self):
+        """Guilds with stored pending requests, whichever process loaded them"""
+        with self.lock:
+            rows = self.connect().execute("SELECT DISTINCT guild_id FROM pending_requests").fetchall()
+        return [guild_id for (guild_id,) in rows]
+
+    def read_changes(self):
+        """Return changes other processes logged since the last call"""
+        with self.lock:
+            rows = self.connect().execute(
+                "SELECT seq, origin, change FROM changes WHERE seq > ? ORDER BY seq",
+                (self.cursor,)
+            ).fetchall()
+        if rows:
+            self.cursor = rows[-1][0]
+        return [json.loads(change) for seq, origin, change in rows if origin != self.origin]
+
+def create_storage():
+    """Build the storage backend selected by STORAGE_BACKEND"""
+    if SHARD_IDS:
+        # Processes running a subset of shards share whitelist state through one database
+        return SqliteBackend(DATABASE_FILE, publish=True)
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteBackend(DATABASE_FILE)
+    if STORAGE_BACKEND == 'journal':
+        return JournalBackend(JOURNAL_FILE, JOURNAL_COMPACT_AFTER)
+    return JsonBackend()
+
+storage = create_storage()
+
+def load_data():
+    """Load the whitelist, scheduling its grant expiries and queueing its pending requests"""
+    data = storage.load()
+    expiry_scheduler.clear()
+    request_queue.clear()
+    for guild_id, entries in ((GLOBAL_GUILD_ID, data), *((int(key), entries) for key, entries in data["guilds"].items())):
+        expiry_scheduler.load(guild_id, entries)
+        request_queue.load(guild_id, entries)
+    return data
+
+class DataWriter:
+    """Debounced background writer that hands batched changes to storage"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.task = None
+        self.pending = []
+
+    def schedule(self, change):
+        """Queue a change record and start a write if none is pending"""
+        self.pending.append(change)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def take_batch(self):
+        """Detach the pending changes plus a snapshot if storage wants one"""
+        changes, self.pending = self.pending, []
+        snapshot = None
+        if storage.needs_snapshot(len(changes)):
+            snapshot = snapshot_data(bot.whitelist_data)
+        return changes, snapshot
+
+    async def run(self):
+        # Let a burst of changes settle so they share one write
+        await asyncio.sleep(self.delay)
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            changes, snapshot = self.take_batch()
+            try:
+                await loop.run_in_executor(None, storage.write, changes, snapshot)
+            except Exception as e:
+                print(f"Error saving whitelist data: {e}")
+                if snapshot is None and len(changes) > 1:
+                    failed = await loop.run_in_executor(None, self.write_each, changes)
+                    if len(failed) < len(changes):
+                        # The others saved, so these fail on their own; retrying can't help
+                        for change in failed:
+                            print(f"Dropped whitelist change that can't be saved: {change}")
+                        continue
+                # Keep the batch so the next write or flush retries it
+                self.pending = changes + self.pending
+                return
+
+    def write_each(self, changes):
+        """Write changes one at a time; returns the ones that failed"""
+        failed = []
+        for change in changes:
+            try:
+                storage.write([change], None)
+            except Exception:
+                failed.append(change)
+        return failed
+
+    def flush(self):
+        """Synchronously write any unsaved changes (used at shutdown)"""
+        if self.pending:
+            storage.write(*self.take_batch())
+
+data_writer = DataWriter(SAVE_DELAY)
+
+class ExpiryScheduler:
+    """Expire time-limited grants from one task sleeping until the earliest deadline
+
+    Deadlines sit in a min-heap. Moved or cancelled grants leave their old
+    heap entry behind; it is skipped when it reaches the top because it no
+    longer matches self.deadlines.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}  # (guild_id, kind, target_id) -> deadline (Unix time)
+        self.task = None
+
+    def load(self, guild_id, entries):
+        """Schedule every stored expiry of one scope"""
+        for kind, target_id, deadline in entries[ENTRY_KEYS["expiries"]]:
+            self.schedule(guild_id, kind, target_id, deadline)
+
+    def schedule(self, guild_id, kind, target_id, deadline):
+        self.deadlines[(guild_id, kind, target_id)] = deadline
+        heapq.heappush(self.heap, (deadline, guild_id, kind, target_id))
+        if self.heap[0][0] == deadline:
+            # New earliest deadline: wake the task so it sleeps for less
+            self.start()
+
+    def cancel(self, guild_id, kind, target_id):
+        self.deadlines.pop((guild_id, kind, target_id), None)
+
+    def forget_guild(self, guild_id):
+        """Drop an unloaded guild's deadlines; they are scheduled again when it loads"""
+        for key in [key for key in self.deadlines if key[0] == guild_id]:
+            del self.deadlines[key]
+
+    def clear(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def start(self):
+        """(Re)start the task; before the event loop runs, on_ready starts it"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self.task is not None:
+            self.task.cancel()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.heap:
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            # Everything due now expires in one batch per scope
+            due = {}
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, guild_id, kind, target_id = heapq.heappop(self.heap)
+                if self.deadlines.get((guild_id, kind, target_id)) == deadline:
+                    due.setdefault(guild_id, []).append((kind, target_id))
+            for guild_id, targets in due.items():
+                try:
+                    expired = set_whitelisted_many(guild_id, targets, False, include_global=False)
+                    metrics.count('grants_expired', len(expired))
+                except Exception as e:
+                    print(f"Error expiring whitelist grants: {e}")
+                # Entries of guilds that aren't loaded expire when they load
+                for kind, target_id in targets:
+                    self.cancel(guild_id, kind, target_id)
+
+expiry_scheduler = ExpiryScheduler()
+
+class RequestQueue:
+    """Pending !request entries by (guild, user), reported to the owner in periodic digests
+
+    Repeat requests update the pending entry instead of adding one, and each
+    user can only request once per cooldown. Entries are stored like other
+    whitelist entries and stay until the owner approves or denies them; they
+    carry the latest request time, so cooldowns survive a restart.
+    """
+
+    def __init__(self, cooldown, interval):
+        self.cooldown = cooldown
+        self.interval = interval
+        self.pending = {}  # (guild_id, user_id) -> request record
+        self.last_request = {}  # (guild_id, user_id) -> Unix time of the last accepted request
+        self.unreported = {}  # Keys added or updated since the last digest, in order
+        self.task = None
+
+    def load(self, guild_id, entries):
+        for record in entries[ENTRY_KEYS["requests"]]:
+            key = (guild_id, record[0])
+            self.pending[key] = record
+            self.remember(key, record)
+
+    def remember(self, key, record):
+        """Start the cooldown from a stored request, unless a later one is known"""
+        self.last_request[key] = max(self.last_request.get(key, 0), record[1])
+
+    def forget_guild(self, guild_id):
+        for key in [key for key in self.pending if key[0] == guild_id]:
+            del self.pending[key]
+
+    def clear(self):
+        self.pending = {}
+        self.unreported = {}
+
+    def retry_at(self, key):
+        """Unix time the user may request again, or None if not cooling down"""
+        last = self.last_request.get(key)
+        if last is None or time.time() - last >= self.cooldown:
+            return None
+        return int(last + self.cooldown)
+
+    def submit(self, guild_id, user_id, channel_id, reason):
+        """Queue a request, or update the user's pending one; returns True if it was new"""
+        key = (guild_id, user_id)
+        records = guild_entries(bot.whitelist_data, guild_id, create=True)[ENTRY_KEYS["requests"]]
+        old = self.pending.get(key)
+        now = int(time.time())
+        if old is None:
+            record = [user_id, now, channel_id, reason, 1]
+            records.append(record)
+        else:
+            # An empty repeat keeps the old reason
+            record = [user_id, now, channel_id, reason or old[3], old[4] + 1]
+            records[records.index(old)] = record
+            data_writer.schedule(("-", guild_id, "requests", old))
+        data_writer.schedule(("+", guild_id, "requests", record))
+        self.pending[key] = record
+        self.remember(key, record)
+        self.unreported[key] = None
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+        return old is None
+
+    def close(self, keys):
+        """Remove answered requests, one pass per scope; returns the records removed"""
+        closed = {}
+        for key in keys:
+            record = self.pending.pop(key, None)
+            if record is not None:
+                closed.setdefault(key[0], []).append(record)
+                self.unreported.pop(key, None)
+        for guild_id, records in closed.items():
+            for record in records:
+                data_writer.schedule(("-", guild_id, "requests", record))
+            removed = {entry_key(record) for record in records}
+            stored = guild_entries(bot.whitelist_data, guild_id)[ENTRY_KEYS["requests"]]
+            stored[:] = [record for record in stored if entry_key(record) not in removed]
+        return [(guild_id, record) for guild_id, records in closed.items() for record in records]
+
+    async def run(self):
+        # Everything submitted during the interval shares one digest
+        while self.unreported:
+            await asyncio.sleep(self.interval)
+            keys = [key for key in self.unreported if key in self.pending]
+            self.unreported = {}
+            now = time.time()
+            self.last_request = {key: last for key, last in self.last_request.items() if now - last < self.cooldown}
+            if keys:
+                try:
+                    await send_request_digest(keys)
+                except Exception as e:
+                    print(f"Error sending request digest: {e}")
+
+request_queue = RequestQueue(REQUEST_COOLDOWN, REQUEST_DIGEST_INTERVAL)
+
+def grant_deadline(guild_id, kind, target_id):
+    """When a target's whitelist entry in a guild (or globally) expires, None if permanent"""
+    for scope in dict.fromkeys((guild_id, GLOBAL_GUILD_ID)):
+        deadline = expiry_scheduler.deadlines.get((scope, kind, target_id))
+        if deadline is not None:
+            return deadline
+    return None
+
+def clear_grant_expiries(guild_id, targets):
+    """Make many (kind, ID) entries of one scope permanent again"""
+    cleared = set()
+    for kind, target_id in targets:
+        deadline = expiry_scheduler.deadlines.get((guild_id, kind, target_id))
+        if deadline is not None:
+            cleared.add((kind, target_id, deadline))
+            expiry_scheduler.cancel(guild_id, kind, target_id)
+            data_writer.schedule(("-", guild_id, "expiries", [kind, target_id, deadline]))
+    if cleared:
+        # One pass over the records, however many expire together
+        records = guild_entries(bot.whitelist_data, guild_id)[ENTRY_KEYS["expiries"]]
+        records[:] = [record for record in records if tuple(record) not in cleared]
+
+def set_grant_expiry(guild_id, kind, target_id, deadline):
+    """Set, move or clear (deadline None) the expiry of a whitelist entry"""
+    if expiry_scheduler.deadlines.get((guild_id, kind, target_id)) == deadline:
+        return
+    clear_grant_expiries(guild_id, [(kind, target_id)])
+    if deadline is not None:
+        guild_entries(bot.whitelist_data, guild_id, create=True)[ENTRY_KEYS["expiries"]].append([kind, target_id, deadline])
+        data_writer.schedule(("+", guild_id, "expiries", [kind, target_id, deadline]))
+        expiry_scheduler.schedule(guild_id, kind, target_id, deadline)
+
+class PermissionIndex:
+    """Immutable snapshot of one guild's whitelisted user and role IDs for O(1) lookups"""
+
+    def __init__(self, global_entries, entries=None):
+        users = set(global_entries["whitelisted_users"])
+        roles = set(global_entries["whitelisted_roles"])
+        if entries:
+            users.update(entries["whitelisted_users"])
+            roles.update(entries["whitelisted_roles"])
+        self.users = frozenset(users)
+        self.roles = frozenset(roles)
+        self.sorted_ids = None
+
+    def matching_roles(self, user):
+        """Return the IDs of the user's roles that are whitelisted"""
+        if not self.roles or not hasattr(user, 'roles'):
+            return frozenset()
+        return self.roles.intersection(role.id for role in user.roles)
+
+    def listing(self):
+        """Sorted user and role IDs, built on first use"""
+        # The index is replaced on every change, so the sorted copy never goes stale
+        if self.sorted_ids is None:
+            self.sorted_ids = (sorted(self.users), sorted(self.roles))
+        return self.sorted_ids
+
+class DecisionCache:
+    """Bounded LRU cache with expiring entries (allow/deny decisions, invite lookups)"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached decision, or None on a miss or expired entry"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            allowed, expires = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return allowed
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, allowed, ttl=None):
+        self.entries[key] = (allowed, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def invalidate_guild(self, guild_id):
+        for key in [key for key in self.entries if key[0] == guild_id]:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+decision_cache = DecisionCache(PERMISSION_CACHE_SIZE, PERMISSION_CACHE_TTL)
+
+def guild_id_of(guild):
+    """Whitelist scope for a guild, or the global scope outside guilds"""
+    return guild.id if guild else GLOBAL_GUILD_ID
+
+def rebuild_index(guild_id):
+    """Swap in a fresh permission index for one guild"""
+    # Replaced in one assignment so readers never see a half-built index
+    index = PermissionIndex(bot.whitelist_data, guild_entries(bot.whitelist_data, guild_id))
+    bot.permission_indexes[guild_id] = index
+    return index
+
+def get_permission_index(guild_id):
+    index = bot.permission_indexes.get(guild_id)
+    if index is None:
+        index = rebuild_index(guild_id)
+    return index
+
+def whitelisted_ids(guild_id, kind):
+    """Return global plus guild whitelisted IDs of one kind, in insertion order"""
+    ids = dict.fromkeys(bot.whitelist_data[ENTRY_KEYS[kind]])
+    entries = guild_entries(bot.whitelist_data, guild_id)
+    if entries and guild_id != GLOBAL_GUILD_ID:
+        ids.update(dict.fromkeys(entries[ENTRY_KEYS[kind]]))
+    return list(ids)
+
+def count_entries(kind):
+    """Count loaded whitelist entries of one kind across every scope"""
+    data = bot.whitelist_data
+    return len(data[ENTRY_KEYS[kind]]) + sum(
+        len(entries[ENTRY_KEYS[kind]]) for entries in data["guilds"].values()
+    )
+
+def set_whitelisted(guild_id, kind, target_id, whitelisted):
+    """Add or remove an ID from a guild's whitelist ("users" or "roles")
+
+    Removing also drops a matching global entry so the target really loses
+    access. Returns True if the whitelist changed. Schedules a save and
+    reindexes on change.
+    """
+    return bool(set_whitelisted_many(guild_id, [(kind, target_id)], whitelisted))
+
+def set_whitelisted_many(guild_id, targets, whitelisted, include_global=True):
+    """Add or remove many (kind, ID) targets at once, as set_whitelisted does
+
+    Every change record joins the same write batch, and the index and caches
+    are rebuilt once. Adding a time-limited entry again makes it permanent.
+    include_global=False removes only this guild's entries. Returns the
+    targets that changed.
+    """
+    targets = list(dict.fromkeys(targets))
+    changed = []
+    made_permanent = []
+    if whitelisted:
+        index = get_permission_index(guild_id)
+        added = []
+        for kind, target_id in targets:
+            if target_id not in getattr(index, kind):
+                added.append((kind, target_id))
+            elif (guild_id, kind, target_id) in expiry_scheduler.deadlines:
+                made_permanent.append((kind, target_id))
+        clear_grant_expiries(guild_id, made_permanent)
+        if added:
+            entries = guild_entries(bot.whitelist_data, guild_id, create=True)
+            for kind, target_id in added:
+                entries[ENTRY_KEYS[kind]].append(target_id)
+                changed.append((guild_id, kind, target_id))
+    else:
+        scopes = (guild_id, GLOBAL_GUILD_ID) if include_global else (guild_id,)
+        for scope in dict.fromkeys(scopes):
+            entries = guild_entries(bot.whitelist_data, scope)
+            if not entries:
+                continue
+            for kind in ("users", "roles"):
+                removed = {target_id for target_kind, target_id in targets if target_kind == kind}
+                ids = entries[ENTRY_KEYS[kind]]
+                if removed.isdisjoint(ids):
+                    continue
+                changed.extend((scope, kind, target_id) for target_id in ids if target_id in removed)
+                # Filtered in one pass; removing one by one is quadratic for big batches
+                ids[:] = [target_id for target_id in ids if target_id not in removed]
+        for scope in dict.fromkeys(scopes):
+            clear_grant_expiries(scope, [(kind, target_id) for changed_scope, kind, target_id in changed if changed_scope == scope])
+    if not changed:
+        return made_permanent
+    
+    for scope, kind, target_id in changed:
+        data_writer.schedule(("+" if whitelisted else "-", scope, kind, target_id))
+    
+    # Any cached decision in the affected scope may depend on these entries
+    if any(scope == GLOBAL_GUILD_ID for scope, kind, target_id in changed):
+        bot.permission_indexes = {}
+        decision_cache.clear()
+    else:
+        rebuild_index(guild_id)
+        decision_cache.invalidate_guild(guild_id)
+    return made_permanent + list(dict.fromkeys((kind, target_id) for scope, kind, target_id in changed))
+
+def grant_temporary(guild_id, kind, target_id, deadline):
+    """Whitelist a target until deadline (Unix time), or move an existing grant's deadline
+
+    Returns False if the target is already permanently whitelisted.
+    """
+    if (guild_id, kind, target_id) not in expiry_scheduler.deadlines:
+        if not set_whitelisted(guild_id, kind, target_id, True):
+            return False
+    set_grant_expiry(guild_id, kind, target_id, deadline)
+    return True
+
+def guild_loaded(guild_id):
+    """Check if a guild's whitelist is in memory (always true for eager storage)"""
+    if not storage.lazy or guild_id == GLOBAL_GUILD_ID:
+        return True
+    task = bot.guild_loads.get(guild_id)
+    return task is not None and task.done()
+
+async def load_guild(guild_id):
+    """Pull a guild's whitelist from lazy storage into memory, once"""
+    if not storage.lazy or guild_id == GLOBAL_GUILD_ID:
+        return
+    task = bot.guild_loads.get(guild_id)
+    if task is None:
+        task = bot.guild_loads[guild_id] = asyncio.get_running_loop().create_task(read_guild(guild_id))
+    try:
+        # Shielded: one cancelled caller must not cancel the load others wait on
+        await asyncio.shield(task)
+    except Exception:
+        if bot.guild_loads.get(guild_id) is task:
+            del bot.guild_loads[guild_id]
+        raise
+
+async def read_guild(guild_id):
+    loop = asyncio.get_running_loop()
+    entries = await loop.run_in_executor(None, storage.load_guild, guild_id)
+    if bot.guild_loads.get(guild_id) is not asyncio.current_task():
+        return  # Unloaded (left the guild) while the query ran
+    existing = bot.whitelist_data["guilds"].get(str(guild_id))
+    if existing is None:
+        bot.whitelist_data["guilds"][str(guild_id)] = entries
+    else:
+        # Entries a change added before the load finished are kept after the stored ones
+        for key, stored in entries.items():
+            known = {entry_key(target) for target in stored}
+            stored.extend(target for target in existing[key] if entry_key(target) not in known)
+            existing[key] = stored
+        entries = existing
+    expiry_scheduler.load(guild_id, entries)
+    request_queue.load(guild_id, entries)
+    bot.domain_tries.pop(guild_id, None)
+    rebuild_index(guild_id)
+    decision_cache.invalidate_guild(guild_id)
+    # Other processes' changes that arrived meanwhile may postdate the rows just read
+    deferred = bot.deferred_changes.pop(guild_id, None)
+    if deferred:
+        replay_remote_changes(deferred)
+
+def unload_guild(guild_id):
+    """Drop a guild's whitelist from memory when storage can reload it"""
+    if storage.lazy:
+        bot.guild_loads.pop(guild_id, None)
+        bot.deferred_changes.pop(guild_id, None)
+        bot.whitelist_data["guilds"].pop(str(guild_id), None)
+        bot.permission_indexes.pop(guild_id, None)
+        bot.domain_tries.pop(guild_id, None)
+        expiry_scheduler.forget_guild(guild_id)
+        request_queue.forget_guild(guild_id)
+    decision_cache.invalidate_guild(guild_id)
+
+# Shared state
+# Sharded processes write to one SQLite database, which logs every change.
+# Each process polls that log and applies other processes' changes to the
+# scopes it has loaded; scopes it loads later are read with them included.
+def apply_remote_changes(changes):
+    """Apply change records written by another process to the scopes loaded here"""
+    loaded = []
+    for change in changes:
+        guild_id = change[1]
+        load = bot.guild_loads.get(guild_id)
+        if guild_id == GLOBAL_GUILD_ID or (load is not None and load.done()):
+            loaded.append(change)
+        elif load is not None:
+            # The load's query may have run before this change was committed
+            bot.deferred_changes.setdefault(guild_id, []).append(change)
+    if loaded:
+        replay_remote_changes(loaded)
+
+def replay_remote_changes(changes):
+    """Replay changes from other processes into memory, updating indexes and caches"""
+    replay_changes(bot.whitelist_data, changes)
+    for op, guild_id, kind, target in changes:
+        if kind == "expiries":
+            target_kind, target_id, deadline = target
+            if op == "+":
+                expiry_scheduler.schedule(guild_id, target_kind, target_id, deadline)
+            elif expiry_scheduler.deadlines.get((guild_id, target_kind, target_id)) == deadline:
+                expiry_scheduler.cancel(guild_id, target_kind, target_id)
+        elif kind == "requests":
+            key = (guild_id, target[0])
+            if op == "+":
+                request_queue.pending[key] = target
+                request_queue.remember(key, target)
+            elif request_queue.pending.get(key) == target:
+                del request_queue.pending[key]
+    
+    # Rules change the built tries in place; rebuilding a big one would stall the loop
+    rules = {}
+    for op, guild_id, kind, target in changes:
+        if kind in DOMAIN_KINDS and guild_id in bot.domain_tries:
+            rules.setdefault(guild_id, set()).add(target)
+    for guild_id, changed in rules.items():
+        # The verdict after the whole batch, whatever order its records came in
+        entries = guild_entries(bot.whitelist_data, guild_id)
+        allowed = changed.intersection(entries[ENTRY_KEYS["allowed"]])
+        blocked = changed.intersection(entries[ENTRY_KEYS["blocked"]])
+        trie = bot.domain_tries[guild_id]
+        for rule in changed:
+            trie.set(rule, True if rule in allowed else False if rule in blocked else None)
+    
+    scopes = {guild_id for op, guild_id, kind, target in changes}
+    if GLOBAL_GUILD_ID in scopes:
+        bot.permission_indexes = {}
+        decision_cache.clear()
+        spam_fingerprints.clear()
+        return
+    for guild_id in scopes:
+        rebuild_index(guild_id)
+        decision_cache.invalidate_guild(guild_id)
+        spam_fingerprints.invalidate_guild(guild_id)
+
+class ChangeFeed:
+    """Poll the shared database for changes made by other processes"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                changes = await loop.run_in_executor(None, storage.read_changes)
+                if changes:
+                    apply_remote_changes(changes)
+                    metrics.count('remote_changes', len(changes))
+            except Exception as e:
+                print(f"Error reading shared changes: {e}")
+
+change_feed = ChangeFeed(CHANGE_POLL_INTERVAL)
 
 # Initialize data
+bot.metrics_server = None
 bot.whitelist_data = load_data()
+bot.permission_indexes = {}
+bot.domain_tries = {}
+bot.guild_loads = {}  # guild_id -> task loading it from lazy storage (done once loaded)
+bot.deferred_changes = {}  # guild_id -> remote changes that arrived while it loaded
 
-def is_allowed(user):
-    """Check if user is allowed to post links"""
+def is_allowed(user, guild=None):
+    """Check if user is allowed to post links (in guild, for non-members)"""
     # Owner can always post links
     if user.id == OWNER_ID:
         return True
     
+    member_guild = getattr(user, 'guild', None)
+    if member_guild is None:
+        # Plain users carry no roles, so their answer isn't cached per member
+        return check_whitelist(user, guild_id_of(guild))
+    
+    key = (member_guild.id, user.id)
+    allowed = decision_cache.get(key)
+    if allowed is None:
+        allowed = check_whitelist(user, member_guild.id)
+        decision_cache.put(key, allowed)
+    return allowed
+
+def check_whitelist(user, guild_id):
+    """Check a guild's whitelist index for the user or any of their roles"""
+    index = get_permission_index(guild_id)
+    
     # Check whitelisted users
-    if user.id in bot.whitelist_data["whitelisted_users"]:
+    if user.id in index.users:
         return True
     
     # Check whitelisted roles
-    if hasattr(user, 'roles'):
-        user_roles = [role.id for role in user.roles]
-        for role_id in bot.whitelist_data["whitelisted_roles"]:
-            if role_id in user_roles:
-                return True
+    if index.roles and hasattr(user, 'roles'):
+        return not index.roles.isdisjoint(role.id for role in user.roles)
     
     return False
 
 def contains_links(text):
     """Check if text contains any links"""
-    for pattern in LINK_PATTERNS:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
-    return False
+    return link_detector.detect(text) is not None
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
-    print(f'Bot Owner ID: {OWNER_ID}')
-    print(f'Whitelisted Users: {len(bot.whitelist_data["whitelisted_users"])}')
-    print(f'Whitelisted Roles: {len(bot.whitelist_data["whitelisted_roles"])}')
-    await bot.change_presence(activity=discord.Game(name="!help - Owner/Whitelist Only"))
+# Domain rules
+# Each scope (a guild, or global) can allow or block domains. A rule is a
+# host ("docs.example.com") or a wildcard ("*.example.com") that covers the
+# domain and all of its subdomains. The most specific rule wins, and a
+# guild's rules win over global ones. Anyone may post allowed domains;
+# blocked domains are deleted even from whitelisted users.
+DOMAIN_LABEL = re.compile(r'[a-z0-9-]{1,63}')
 
-@bot.event
-async def on_message(message):
-    # Don't process bot's own messages
-    if message.author.bot:
-        return
+def normalize_domain_rule(rule):
+    """Return a rule as "example.com" or "*.example.com", or None if it isn't one"""
+    rule = rule.strip().lower().split('://', 1)[-1].split('/', 1)[0].rstrip('.')
+    labels = (rule[2:] if rule.startswith('*.') else rule).split('.')
+    if len(labels) < 2 or len(rule) > 253 or not all(DOMAIN_LABEL.fullmatch(label) for label in labels):
+        return None
+    return rule
+
+def link_host(link):
+    """Return the lowercased host name of a detected link"""
+    return link.split('://', 1)[-1].split('/', 1)[0].lower()
+
+class DomainNode:
+    __slots__ = ('children', 'exact', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.wildcard = None
+
+class DomainTrie:
+    """One scope's domain rules, keyed by reversed labels (com -> example -> docs)
+
+    A lookup walks one node per label of the host, so its cost depends on
+    the host's label count, not on how many rules there are.
+    """
+
+    def __init__(self, entries=None):
+        self.root = DomainNode()
+        self.blocked = 0
+        if entries:
+            for rule in entries["allowed_domains"]:
+                self.set(rule, True)
+            for rule in entries["blocked_domains"]:
+                self.set(rule, False)
+
+    def set(self, rule, allowed):
+        """Allow (True), block (False) or clear (None) a normalized rule"""
+        wildcard = rule.startswith('*.')
+        node = self.root
+        for label in reversed((rule[2:] if wildcard else rule).split('.')):
+            child = node.children.get(label)
+            if child is None:
+                if allowed is None:
+                    return
+                child = node.children[label] = DomainNode()
+            node = child
+        slot = 'wildcard' if wildcard else 'exact'
+        previous = getattr(node, slot)
+        setattr(node, slot, allowed)
+        self.blocked += (allowed is False) - (previous is False)
+
+    def lookup(self, host):
+        """Return True if host is allowed, False if blocked, None if no rule matches"""
+        verdict = None
+        node = self.root
+        for label in reversed(host.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return verdict
+            if node.wildcard is not None:
+                verdict = node.wildcard
+        if node.exact is not None:
+            return node.exact
+        return verdict
+
+def get_domain_trie(guild_id):
+    trie = bot.domain_tries.get(guild_id)
+    if trie is None:
+        trie = bot.domain_tries[guild_id] = DomainTrie(guild_entries(bot.whitelist_data, guild_id))
+    return trie
+
+def domain_verdict(guild_id, host):
+    """Return True if host is allowed in a guild, False if blocked, None if no rule matches"""
+    if guild_id != GLOBAL_GUILD_ID:
+        verdict = get_domain_trie(guild_id).lookup(host)
+        if verdict is not None:
+            return verdict
+    return get_domain_trie(GLOBAL_GUILD_ID).lookup(host)
+
+def has_blocked_domains(guild_id):
+    return bool(get_domain_trie(guild_id).blocked or get_domain_trie(GLOBAL_GUILD_ID).blocked)
+
+def disallowed_links(guild_id, links, allowed):
+    """Return the links an author may not post, given whether they are whitelisted"""
+    disallowed = []
+    for match in links:
+        verdict = domain_verdict(guild_id, link_host(match.link))
+        if verdict is False or (verdict is None and not allowed):
+            disallowed.append(match)
+    return disallowed
+
+def domain_rules(guild_id, kind):
+    """Return one scope's "allowed" or "blocked" rules"""
+    entries = guild_entries(bot.whitelist_data, guild_id)
+    return list(entries[ENTRY_KEYS[kind]]) if entries else []
+
+def set_domain_rule(guild_id, rule, allowed):
+    """Allow (True), block (False) or clear (None) a domain rule in one scope
+
+    A rule is either allowed or blocked, so setting one replaces the other.
+    Returns True if the rules changed. Schedules a save and updates the trie.
+    """
+    entries = guild_entries(bot.whitelist_data, guild_id, create=allowed is not None)
+    if entries is None:
+        return False
+    changes = []
+    for kind, verdict in (("allowed", True), ("blocked", False)):
+        rules = entries[ENTRY_KEYS[kind]]
+        if verdict is allowed:
+            if rule not in rules:
+                rules.append(rule)
+                changes.append(("+", guild_id, kind, rule))
+        elif rule in rules:
+            rules.remove(rule)
+            changes.append(("-", guild_id, kind, rule))
+    if not changes:
+        return False
     
-    # Check if user is allowed to post links
-    if is_allowed(message.author):
-        await bot.process_commands(message)
-        return
+    for change in changes:
+        data_writer.schedule(change)
+    get_domain_trie(guild_id).set(rule, allowed)
+    # Remembered spam payloads were judged under the old rules
+    if guild_id == GLOBAL_GUILD_ID:
+        spam_fingerprints.clear()
+    else:
+        spam_fingerprints.invalidate_guild(guild_id)
+    return True
+
+# Invite resolution
+# Invite codes are resolved to the guild they point to, so invites to the
+# server itself (and ALLOWED_INVITE_GUILDS) pass. Each code is fetched at
+# most once per TTL: results, including invalid codes, go into an LRU cache,
+# and codes seen while a fetch is pending wait for that fetch.
+def invite_code(link):
+    """Return the code at the end of an invite link"""
+    return link.rstrip('/').rsplit('/', 1)[-1]
+
+async def fetch_invite_guild(code):
+    """Return the ID of the guild an invite points to, or None for group DM invites"""
+    invite = await bot.fetch_invite(code, with_counts=False)
+    return invite.guild.id if invite.guild else None
+
+class InviteResolver:
+    """Cached, batched lookups of invite code -> guild ID"""
+
+    def __init__(self, fetch, cache, negative_ttl, delay, concurrency):
+        self.fetch = fetch
+        self.cache = cache
+        self.negative_ttl = negative_ttl
+        self.delay = delay
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue = []
+        self.futures = {}
+        self.task = None
+
+    async def resolve(self, codes, limit=None):
+        """Return {code: guild ID, or None if the invite is invalid or couldn't be fetched}
+
+        At most limit uncached codes are fetched; the rest map to None too.
+        """
+        results = {}
+        waiting = {}
+        for code in codes:
+            # False marks a cached invalid invite, None a cache miss
+            guild_id = self.cache.get(code)
+            if guild_id is not None:
+                results[code] = guild_id or None
+            elif code in waiting:
+                continue
+            elif limit is not None and len(waiting) >= limit:
+                results[code] = None
+            else:
+                waiting[code] = self.submit(code)
+        for code, future in waiting.items():
+            # Shielded: cancelling one waiter must not cancel the fetch others share
+            results[code] = await asyncio.shield(future)
+        return results
+
+    def submit(self, code):
+        """Return a future for code, queueing a fetch unless one is pending"""
+        future = self.futures.get(code)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.futures[code] = loop.create_future()
+            self.queue.append(code)
+            if self.task is None or self.task.done():
+                self.task = loop.create_task(self.run())
+        return future
+
+    async def run(self):
+        # Let a burst of codes (an invite raid) gather into one batch
+        await asyncio.sleep(self.delay)
+        while self.queue:
+            batch, self.queue = self.queue, []
+            await asyncio.gather(*(self.lookup(code) for code in batch))
+
+    async def lookup(self, code):
+        guild_id = None
+        try:
+            async with self.slots:
+                metrics.count('invite_fetches')
+                guild_id = await self.fetch(code)
+            self.cache.put(code, guild_id or False)
+        except discord.NotFound:
+            # Expired or made up; cached for a shorter time in case it's recreated
+            self.cache.put(code, False, self.negative_ttl)
+        except Exception as e:
+            # Not cached, so the next message with this code tries again
+            print(f"Error resolving invite {code}: {e}")
+        finally:
+            future = self.futures.pop(code)
+            if not future.done():
+                future.set_result(guild_id)
+
+invite_resolver = InviteResolver(
+    fetch_invite_guild,
+    DecisionCache(INVITE_CACHE_SIZE, INVITE_CACHE_TTL),
+    INVITE_NEGATIVE_TTL, INVITE_BATCH_DELAY, INVITE_FETCH_CONCURRENCY
+)
+
+async def drop_allowed_invites(guild_id, links):
+    """Return links without invites to the guild itself or ALLOWED_INVITE_GUILDS"""
+    codes = [invite_code(match.link) for match in links if match.category == 'invite']
+    # Another disallowed link gets the message deleted anyway; don't spend fetches on it
+    if not codes or len(codes) < len(links):
+        return links
+    allowed_guilds = set(ALLOWED_INVITE_GUILDS)
+    if guild_id != GLOBAL_GUILD_ID:
+        allowed_guilds.add(guild_id)
+    # A message stuffed with codes can't use up the invite endpoint's rate limit
+    guilds = await invite_resolver.resolve(codes, INVITE_CODES_PER_MESSAGE)
+    
+    remaining = []
+    for match in links:
+        if match.category == 'invite' and guilds[invite_code(match.link)] in allowed_guilds:
+            # An explicit domain block still applies to these invites
+            if domain_verdict(guild_id, link_host(match.link)) is not False:
+                continue
+        remaining.append(match)
+    return remaining
+
+# Message scanning
+# Scans of large texts run in worker processes so a long message or a text
+# attachment full of URLs can't hold up heartbeats and other guilds' events.
+# Threads wouldn't help: the regex engine holds the GIL while it scans.
+# Workers are forked, so they share the compiled detector instead of
+# importing the bot again; the links found are the same either way.
+def extract_links(text):
+    """Return every distinct link in text (module level, so workers can run it)"""
+    return link_detector.extract(text)
+
+def extract_file_links(data):
+    """Decode a text attachment and extract its links"""
+    return link_detector.extract(data.decode('utf-8', errors='replace'))
+
+class ScanPool:
+    """Runs link scans inline when small and in worker processes when large"""
+
+    def __init__(self, threshold, workers, queue_size):
+        self.threshold = threshold
+        self.workers = workers
+        self.executor = None
+        # Bounded queue: scans waiting for, or running on, a worker. Once it
+        # is full, new large scans wait here instead of piling up in memory.
+        self.slots = asyncio.Semaphore(queue_size)
+
+    def start(self):
+        """Fork the workers; call before the event loop (and its threads) start"""
+        if self.executor is None:
+            method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            # A fork pool starts every worker on its first task
+            self.executor.submit(len, '').result()
+
+    async def run(self, func, data):
+        """Return func(data), computed in a worker process if data is large"""
+        # Without a pool (never started, or broken) every scan runs inline
+        if len(data) < self.threshold or self.executor is None:
+            return func(data)
+        async with self.slots:
+            with metrics.timer('scan.offloaded'):
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(self.executor, func, data)
+                except BrokenProcessPool as e:
+                    # A worker died (killed, out of memory). Forking from the running loop
+                    # isn't safe, so scans stay inline until the bot restarts.
+                    print(f"Error in scan worker, scanning inline until restart: {e}")
+                    if self.executor is not None:
+                        self.executor.shutdown(wait=False)
+                        self.executor = None
+                    return func(data)
+
+    async def extract(self, text):
+        """Return every distinct link in text as LinkMatch tuples"""
+        return await self.run(extract_links, text)
+
+    async def extract_file(self, data):
+        """Return every distinct link in the bytes of a text attachment"""
+        return await self.run(extract_file_links, data)
+
+scan_pool = ScanPool(SCAN_OFFLOAD_THRESHOLD, SCAN_WORKERS, SCAN_QUEUE_SIZE)
+
+def is_text_attachment(attachment):
+    """Check if an attachment is a text file small enough to scan"""
+    if attachment.size > ATTACHMENT_SCAN_MAX_BYTES:
+        return False
+    content_type = attachment.content_type or ''
+    return content_type.startswith('text/') or attachment.filename.lower().endswith(TEXT_ATTACHMENT_EXTENSIONS)
+
+async def scan_attachment(attachment):
+    """Return the links in a text attachment (other files have none)"""
+    if not is_text_attachment(attachment):
+        return []
+    try:
+        data = await attachment.read()
+    except Exception as e:
+        print(f"Error reading attachment {attachment.filename}: {e}")
+        return []
+    return await scan_pool.extract_file(data)
+
+async def scan_message(message):
+    """Return every distinct link in a message, its embeds and text attachments"""
+    links = await scan_pool.extract(message.content)
+    if not SCAN_ATTACHMENTS or not (message.attachments or message.embeds):
+        return links
+    
+    found = {match.link: match for match in links}
+    sources = await asyncio.gather(*(scan_attachment(attachment) for attachment in message.attachments))
+    embed_urls = "\n".join(embed.url for embed in message.embeds if embed.url)
+    sources.append(await scan_pool.extract(embed_urls))
+    for matches in sources:
+        for match in matches:
+            found.setdefault(match.link, match)
+    return list(found.values())
+
+# Moderation actions
+# Violations are queued per channel and handled in batches so a raid costs
+# one bulk delete, one log embed and one warning per batch instead of four
+# API calls per message. Members who keep posting links past
+# VIOLATION_THRESHOLD get a timeout instead of more warnings and DMs.
+
+# A message that has to be removed and the links found in it
+Violation = namedtuple('Violation', ['message', 'links'])
+
+class ViolationWindow:
+    """One member's most recent violation times in a fixed-size ring"""
+    __slots__ = ('times', 'next', 'escalated')
+
+    def __init__(self, size):
+        self.times = array('d', [float('-inf')]) * size
+        self.next = 0
+        self.escalated = float('-inf')
+
+class ViolationTracker:
+    """Sliding-window violation counts per (guild_id, member_id)
+
+    Each member keeps only their last `threshold` violation times, which is
+    all it takes to tell whether `threshold` of them fell inside the window.
+    The least recently seen members are evicted past maxsize.
+    """
+
+    def __init__(self, threshold, window, maxsize):
+        self.threshold = threshold
+        self.window = window
+        self.maxsize = maxsize
+        self.members = OrderedDict()
+
+    def record(self, key):
+        """Record a violation now and return the member's count in the window"""
+        now = time.monotonic()
+        entry = self.members.get(key)
+        if entry is None:
+            entry = self.members[key] = ViolationWindow(self.threshold)
+            if len(self.members) > self.maxsize:
+                self.members.popitem(last=False)
+        else:
+            self.members.move_to_end(key)
+        entry.times[entry.next] = now
+        entry.next = (entry.next + 1) % self.threshold
+        return self.count(entry, now)
+
+    def count(self, entry, now):
+        cutoff = now - self.window
+        return sum(1 for recorded in entry.times if recorded > cutoff)
+
+    def flooding(self, key):
+        """Check if a member reached the threshold within the window"""
+        entry = self.members.get(key)
+        return entry is not None and self.count(entry, time.monotonic()) >= self.threshold
+
+    def escalate(self, key):
+        """Return True once per window for a flooding member"""
+        if not self.flooding(key):
+            return False
+        entry = self.members[key]
+        now = time.monotonic()
+        if now - entry.escalated < self.window:
+            return False
+        entry.escalated = now
+        return True
+
+violation_tracker = ViolationTracker(VIOLATION_THRESHOLD, VIOLATION_WINDOW, VIOLATION_TRACKER_SIZE)
+
+# Embed templates
+# Titles, colors, fixed fields and footers are prepared once; building an
+# embed only fills in the per-event parts.
+def embed_field(name, value, inline=True):
+    return (name, value, inline)
+
+def add_fields(embed, fields):
+    """Add (name, value, inline) fields to an embed; add_field gives each its own dict"""
+    for name, value, inline in fields:
+        embed.add_field(name=name, value=value, inline=inline)
+
+class EmbedTemplate:
+    """The static parts of an embed, filled in per event"""
+
+    def __init__(self, title=None, description=None, color=None, fields=(), footer=None):
+        self.options = {'title': title, 'description': description, 'color': color}
+        self.fields = [embed_field(*field) for field in fields]
+        self.footer = footer
+
+    def render(self, fields=None, footer=None, timestamp=None, **values):
+        """Return a new Embed; fields replaces the template's, other arguments override it"""
+        embed = discord.Embed(timestamp=timestamp, **(dict(self.options, **values) if values else self.options))
+        # Fresh field dicts per embed, so editing one never changes the template
+        add_fields(embed, self.fields if fields is None else fields)
+        footer = self.footer if footer is None else footer
+        if footer is not None:
+            embed.set_footer(text=footer)
+        return embed
+
+LOG_TEMPLATE = EmbedTemplate(title="🔗 Link Deleted", color=discord.Color.red())
+SUMMARY_TEMPLATE = EmbedTemplate(color=discord.Color.red())
+LOG_ACTION_FIELDS = [embed_field("🛡️ Action", "Auto-Deleted"), embed_field("🔒 Status", "Not Whitelisted")]
+DM_TEMPLATE = EmbedTemplate(
+    title="⚠️ Link Removed",
+    color=discord.Color.orange(),
+    footer="Only whitelisted users can post links"
+)
+DM_REASON_FIELD = embed_field("Reason", "You are not whitelisted to post links")
+DM_REQUEST_FIELD = embed_field("Request Access", "Use `!request` in the server to ask for whitelist permission", False)
+
+def truncate(content, limit):
+    return content[:limit] + "..." if len(content) > limit else content
+
+def build_log_embed(violation):
+    """Detailed log embed for a single deleted message"""
+    message = violation.message
+    author = message.author
+    fields = [embed_field("👤 User", f"{author.mention}\n`{author.name}`\nID: `{author.id}`", False)]
     
-    # Check for links in message from non-allowed users
-    if contains_links(message.content):
+    # Show truncated message content
+    if message.content:
+        fields.append(embed_field("📝 Message Content", f"```{truncate(message.content, 500)}```", False))
+    
+    # Show detected links
+    fields.append(embed_field("🔗 Detected Links", "\n".join([f"• `{match.link}`" for match in violation.links[:3]]), False))
+    
+    fields.append(embed_field("📌 Channel", message.channel.mention))
+    fields.extend(LOG_ACTION_FIELDS)
+    return LOG_TEMPLATE.render(fields, timestamp=datetime.utcnow())
+
+def build_summary_embed(channel, violations):
+    """One log embed summarizing a batch of deleted messages"""
+    # Count deleted messages per user
+    counts = {}
+    for violation in violations:
+        author = violation.message.author
+        counts[author.id] = (author, counts.get(author.id, (author, 0))[1] + 1)
+    users = [f"• {author.mention} (`{author.name}`) - {count} message(s)" for author, count in counts.values()]
+    if len(users) > 10:
+        users = users[:10] + [f"...and {len(users) - 10} more"]
+    
+    links = list(dict.fromkeys(match.link for violation in violations for match in violation.links))
+    fields = [
+        embed_field("👤 Users", "\n".join(users), False),
+        embed_field("🔗 Detected Links", "\n".join([f"• `{link}`" for link in links[:5]]), False),
+        embed_field("📌 Channel", channel.mention),
+        *LOG_ACTION_FIELDS
+    ]
+    return SUMMARY_TEMPLATE.render(fields, title=f"🔗 {len(violations)} Links Deleted", timestamp=datetime.utcnow())
+
+def build_dm_embed(violation):
+    """DM telling a user why their message was removed"""
+    message = violation.message
+    fields = [embed_field("Channel", f"#{message.channel.name}"), DM_REASON_FIELD]
+    if message.content:
+        fields.append(embed_field("Your Message", f"```{truncate(message.content, 300)}```", False))
+    fields.append(DM_REQUEST_FIELD)
+    return DM_TEMPLATE.render(
+        fields,
+        description=f"Your message in **{message.guild.name}** was deleted because it contained links."
+    )
+
+async def delete_messages(channel, messages):
+    """Delete messages, in bulk where possible, and return the ones removed
+
+    Bulk deletes only accept messages younger than 14 days; callers must
+    only pass those. Anything the bulk call can't handle is deleted one by one.
+    """
+    deleted = []
+    remaining = messages
+    if len(messages) > 1 and hasattr(channel, 'delete_messages'):
+        try:
+            while remaining:
+                chunk = remaining[:100]
+                await channel.delete_messages(chunk)
+                deleted.extend(chunk)
+                remaining = remaining[100:]
+        except discord.HTTPException:
+            pass  # Fall back to deleting the rest one by one
+    
+    for message in remaining:
         try:
-            # Save message content for log
-            original_content = message.content
-            
-            # Delete the message
             await message.delete()
-            
-            # Create delete log embed
-            embed = discord.Embed(
-                title="🔗 Link Deleted",
-                color=discord.Color.red(),
-                timestamp=datetime.utcnow()
-            )
-            
-            embed.add_field(name="👤 User", value=f"{message.author.mention}\n`{message.author.name}`\nID: `{message.author.id}`", inline=False)
-            
-            # Show truncated message content
-            if original_content:
-                content_preview = original_content[:500] + "..." if len(original_content) > 500 else original_content
-                embed.add_field(name="📝 Message Content", value=f"```{content_preview}```", inline=False)
-            
-            # Extract detected links
-            detected_links = []
-            for pattern in LINK_PATTERNS:
-                matches = re.findall(pattern, original_content, re.IGNORECASE)
-                for match in matches:
-                    if isinstance(match, tuple):
-                        link = ''.join(match)
-                        if link and link not in detected_links:
-                            detected_links.append(link)
-                    elif match and match not in detected_links:
-                        detected_links.append(match)
-            
-            if detected_links:
-                embed.add_field(name="🔗 Detected Links", value="\n".join([f"• `{link}`" for link in detected_links[:3]]), inline=False)
-            
-            embed.add_field(name="📌 Channel", value=f"{message.channel.mention}", inline=True)
-            embed.add_field(name="🛡️ Action", value="Auto-Deleted", inline=True)
-            embed.add_field(name="🔒 Status", value="Not Whitelisted", inline=True)
-            
-            # Try to send log to channel where message was deleted
+            deleted.append(message)
+        except discord.NotFound:
+            pass  # Message already deleted
+        except Exception as e:
+            print(f"Error: {e}")
+    metrics.count('messages_deleted', len(deleted))
+    return deleted
+
+# Duplicate spam
+# Raids post the same payload from many accounts. Payloads that were just
+# flagged are remembered per guild, keyed by a hash of the normalized text,
+# so copies skip link extraction and go straight to the delete queue. When
+# copies keep coming the guild enters raid mode: one running summary
+# replaces the per-batch logs, warnings and DMs until things calm down.
+spam_fingerprints = DecisionCache(FINGERPRINT_CACHE_SIZE, FINGERPRINT_TTL)
+
+def payload_fingerprint(content):
+    """Hash of a message's text with case and whitespace normalized"""
+    return hash(" ".join(content.lower().split()))
+
+class Raid:
+    """Running totals for one guild's raid"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.started = datetime.utcnow()
+        self.last_seen = time.monotonic()
+        self.deleted = 0
+        self.users = set()
+        self.channels = set()
+        self.links = Counter()
+        self.message = None
+
+    def add(self, violations):
+        self.last_seen = time.monotonic()
+        for violation in violations:
+            self.deleted += 1
+            self.users.add(violation.message.author.id)
+            self.channels.add(violation.message.channel.id)
+            self.links.update(match.link for match in violation.links)
+
+def build_raid_embed(raid, active):
+    """Summary of a raid, edited in place while it lasts"""
+    if active:
+        embed = discord.Embed(title="🚨 Raid Mode", description="Copies of the same links are being removed in bulk.", color=discord.Color.red())
+    else:
+        embed = discord.Embed(title="✅ Raid Over", color=discord.Color.green())
+    embed.add_field(name="🗑️ Deleted", value=str(raid.deleted), inline=True)
+    embed.add_field(name="👤 Accounts", value=str(len(raid.users)), inline=True)
+    embed.add_field(name="📌 Channels", value=str(len(raid.channels)), inline=True)
+    top = [f"• `{truncate(link, 80)}` ×{count}" for link, count in raid.links.most_common(5)]
+    embed.add_field(name="🔗 Top Links", value="\n".join(top) or "None", inline=False)
+    embed.set_footer(text=f"Started {raid.started.strftime('%H:%M:%S')} UTC")
+    return embed
+
+class RaidMonitor:
+    """Per-guild raid mode, entered when duplicate spam crosses a threshold"""
+
+    def __init__(self, threshold, window, interval):
+        # A guild's duplicate hits use the same sliding window as a member's violations
+        self.hits = ViolationTracker(threshold, window, 1000)
+        self.window = window
+        self.interval = interval
+        self.raids = {}
+
+    def record(self, message):
+        """Count one duplicate and start raid mode if the guild is over the threshold"""
+        guild_id = guild_id_of(message.guild)
+        self.hits.record(guild_id)
+        if guild_id not in self.raids and self.hits.flooding(guild_id):
+            raid = self.raids[guild_id] = Raid(message.channel)
+            asyncio.get_running_loop().create_task(self.run(guild_id, raid))
+
+    async def run(self, guild_id, raid):
+        try:
+            shown = None
+            # Raid mode lasts until a full window passes without a violation
+            while time.monotonic() - raid.last_seen < self.window:
+                if raid.deleted != shown:
+                    shown = raid.deleted
+                    await self.show(raid, True)
+                await asyncio.sleep(self.interval)
+        finally:
+            del self.raids[guild_id]
+            await self.show(raid, False)
+
+    async def show(self, raid, active):
+        try:
+            if raid.message is None:
+                raid.message = await raid.channel.send(embed=build_raid_embed(raid, active))
+            else:
+                await raid.message.edit(embed=build_raid_embed(raid, active))
+        except Exception as e:
+            print(f"Error: {e}")
+
+raid_monitor = RaidMonitor(RAID_THRESHOLD, RAID_WINDOW, RAID_SUMMARY_INTERVAL)
+
+class ActionQueue:
+    """Per-channel batching of deletes, log embeds, warnings and DMs"""
+
+    def __init__(self, delay, concurrency):
+        self.delay = delay
+        # Bounds how many channels (and DMs) are being worked on at once
+        self.channel_slots = asyncio.Semaphore(concurrency)
+        self.dm_slots = asyncio.Semaphore(concurrency)
+        self.pending = {}
+        self.tasks = {}
+
+    def submit(self, message, links):
+        """Queue a violation; its channel's batch runs after a short delay"""
+        channel = message.channel
+        violation_tracker.record((guild_id_of(message.guild), message.author.id))
+        self.pending.setdefault(channel.id, []).append(Violation(message, links))
+        if channel.id not in self.tasks:
+            self.tasks[channel.id] = asyncio.get_running_loop().create_task(self.run(channel))
+
+    async def run(self, channel):
+        try:
+            # Let a burst pile up so it shares one round of API calls
+            await asyncio.sleep(self.delay)
+            async with self.channel_slots:
+                while self.pending.get(channel.id):
+                    batch = self.pending.pop(channel.id)
+                    try:
+                        with metrics.timer('actions.delete'):
+                            deleted = await self.delete(channel, batch)
+                        if deleted:
+                            with metrics.timer('actions.report'):
+                                await self.report(channel, deleted)
+                    except Exception as e:
+                        print(f"Error: {e}")
+        finally:
+            self.tasks.pop(channel.id, None)
+
+    async def delete(self, channel, batch):
+        """Delete the batch's messages and return the violations removed"""
+        # These messages are seconds old, well inside the bulk delete window
+        deleted = await delete_messages(channel, [violation.message for violation in batch])
+        deleted_ids = {message.id for message in deleted}
+        return [violation for violation in batch if violation.message.id in deleted_ids]
+
+    async def report(self, channel, violations):
+        raid = raid_monitor.raids.get(guild_id_of(violations[0].message.guild))
+        if raid is not None:
+            # The guild's raid summary stands in for logs, warnings and DMs
+            raid.add(violations)
+            return
+        
+        # First violation per user drives the merged warning and their DM
+        first = {}
+        for violation in violations:
+            first.setdefault(violation.message.author.id, violation)
+        
+        # Members flooding links get a timeout (once per window) instead of
+        # more warnings and DMs
+        guild_id = guild_id_of(violations[0].message.guild)
+        flooding = [violation for user_id, violation in first.items() if violation_tracker.flooding((guild_id, user_id))]
+        escalated = [violation for violation in flooding if violation_tracker.escalate((guild_id, violation.message.author.id))]
+        for violation in flooding:
+            del first[violation.message.author.id]
+        
+        # Try to send log to channel where messages were deleted, unless the
+        # batch is only repeat offenders who were already timed out
+        if first or escalated:
+            if len(violations) == 1:
+                embed = build_log_embed(violations[0])
+            else:
+                embed = build_summary_embed(channel, violations)
             try:
-                log_message = await message.channel.send(embed=embed)
+                log_message = await channel.send(embed=embed)
                 # Delete log after 30 seconds
                 await log_message.delete(delay=30)
             except:
                 pass
-            
-            # Send warning to user (deleted after 10 seconds)
+        
+        # One warning per batch mentioning each user once (deleted after 10 seconds)
+        mentions = [violation.message.author.mention for violation in first.values()]
+        if len(mentions) > 20:
+            mentions = mentions[:20] + [f"and {len(mentions) - 20} others"]
+        if mentions:
             try:
-                warning = await message.channel.send(
-                    f"{message.author.mention}, Only whitelisted users can post links! Use `!request` to ask for permission.",
+                await channel.send(
+                    f"{', '.join(mentions)}, Only whitelisted users can post links! Use `!request` to ask for permission.",
                     delete_after=10
                 )
             except:
                 pass
-            
-            # DM the user about the deletion
+        
+        await asyncio.gather(
+            *(self.notify(violation) for violation in first.values()),
+            *(self.timeout(violation.message.author) for violation in escalated)
+        )
+
+    async def timeout(self, member):
+        """Time out a member who went over the violation threshold"""
+        if not hasattr(member, 'timeout'):
+            return
+        try:
+            await member.timeout(TIMEOUT_DURATION, reason="Posting links too fast")
+            metrics.count('timeouts')
+        except Exception as e:
+            print(f"Error: {e}")
+
+    async def notify(self, violation):
+        """DM the user about the deletion"""
+        async with self.dm_slots:
             try:
-                dm_embed = discord.Embed(
-                    title="⚠️ Link Removed",
-                    description=f"Your message in **{message.guild.name}** was deleted because it contained links.",
-                    color=discord.Color.orange()
-                )
-                dm_embed.add_field(name="Channel", value=f"#{message.channel.name}", inline=True)
-                dm_embed.add_field(name="Reason", value="You are not whitelisted to post links", inline=True)
-                if original_content:
-                    content_preview = original_content[:300] + "..." if len(original_content) > 300 else original_content
-                    dm_embed.add_field(name="Your Message", value=f"```{content_preview}```", inline=False)
-                dm_embed.add_field(name="Request Access", value="Use `!request` in the server to ask for whitelist permission", inline=False)
-                dm_embed.set_footer(text="Only whitelisted users can post links")
-                await message.author.send(embed=dm_embed)
+                await violation.message.author.send(embed=build_dm_embed(violation))
             except:
-                pass  # User has DMs closed
+                metrics.count('dm_failures')  # User has DMs closed
+
+action_queue = ActionQueue(ACTION_BATCH_DELAY, ACTION_CONCURRENCY)
+
+# DM broadcasts
+
+def rate_limit_delay(error):
+    """Seconds Discord asked us to wait in a failed response, if it said"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for header in ('Retry-After', 'X-RateLimit-Reset-After'):
+        try:
+            return float(headers[header])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return None
+
+class Broadcast:
+    """Send one embed to many users with bounded concurrency and adaptive pacing"""
+
+    def __init__(self, embed, user_ids, concurrency, retries):
+        self.embed = embed
+        self.user_ids = user_ids
+        self.retries = retries
+        self.slots = asyncio.Semaphore(concurrency)
+        # Pause before each send; raised by rate limits, decays on success
+        self.delay = 0.0
+        self.success = 0
+        self.failed = 0
+
+    @property
+    def done(self):
+        return self.success + self.failed
+
+    async def send_to(self, user_id):
+        async with self.slots:
+            try:
+                user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+            except discord.HTTPException:
+                self.failed += 1
+                metrics.count('dm_failures')
+                return
             
-        except discord.NotFound:
-            pass  # Message already deleted
+            for attempt in range(self.retries + 1):
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                try:
+                    await user.send(embed=self.embed)
+                    self.success += 1
+                    self.delay = self.delay / 2 if self.delay > 0.05 else 0.0
+                    return
+                except discord.Forbidden:
+                    break  # User has DMs closed, retrying won't help
+                except discord.HTTPException as e:
+                    retry_after = rate_limit_delay(e)
+                    if retry_after is not None:
+                        self.delay = max(self.delay, retry_after)
+                    else:
+                        await asyncio.sleep(2 ** attempt)
+            self.failed += 1
+            metrics.count('dm_failures')
+
+    async def run(self, on_progress, interval):
+        """Send to everyone, awaiting on_progress(self) every interval seconds"""
+        sends = asyncio.ensure_future(asyncio.gather(*(self.send_to(user_id) for user_id in self.user_ids)))
+        while not sends.done():
+            await asyncio.wait({sends}, timeout=interval)
+            if not sends.done():
+                await on_progress(self)
+        await sends
+
+def metrics_port():
+    """Metrics port of this process; processes sharing a host need their own"""
+    return METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+
+@bot.event
+async def on_ready():
+    print(f'{bot.user} has connected to Discord!')
+    print(f'Bot Owner ID: {OWNER_ID}')
+    await asyncio.gather(*(load_guild(guild.id) for guild in bot.guilds))
+    expiry_scheduler.start()
+    if getattr(storage, 'publish', False):
+        change_feed.start()
+        print(f'Shards: {", ".join(map(str, SHARD_IDS))} of {SHARD_COUNT}')
+    print(f'Whitelisted Users: {count_entries("users")}')
+    print(f'Whitelisted Roles: {count_entries("roles")}')
+    await bot.change_presence(activity=discord.Game(name="!help - Owner/Whitelist Only"))
+    
+    # on_ready fires again after reconnects; only start the endpoint once
+    if METRICS_PORT and bot.metrics_server is None:
+        try:
+            bot.metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, metrics_port())
+            print(f'Metrics: http://{METRICS_HOST}:{metrics_port()}/metrics')
+        except OSError as e:
+            print(f"Could not start metrics endpoint: {e}")
+
+@bot.event
+async def on_guild_join(guild):
+    await load_guild(guild.id)
+
+@bot.event
+async def on_guild_available(guild):
+    # Guilds (or whole shards) that come up after on_ready
+    await load_guild(guild.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    unload_guild(guild.id)
+
+@bot.event
+async def on_member_update(before, after):
+    # Role changes can flip a member's whitelist status
+    if before.roles != after.roles:
+        decision_cache.invalidate((after.guild.id, after.id))
+
+@bot.event
+async def on_guild_role_delete(role):
+    decision_cache.invalidate_guild(role.guild.id)
+    name_cache.invalidate_guild(role.guild.id)
+
+@bot.event
+async def on_message(message):
+    with metrics.timer('on_message'):
+        await handle_message(message)
+
+async def handle_message(message):
+    # Don't process bot's own messages
+    if message.author.bot:
+        return
+    metrics.count('messages_seen')
+    
+    # Messages can arrive while guilds still load after READY; decide with their whitelist
+    guild_id = guild_id_of(message.guild)
+    if not guild_loaded(guild_id):
+        try:
+            await load_guild(guild_id)
         except Exception as e:
-            print(f"Error: {e}")
-        
+            print(f"Error loading whitelist for guild {guild_id}: {e}")
+    
+    # Check if user is allowed to post links
+    with metrics.timer('on_message.permission'):
+        allowed = is_allowed(message.author)
+        # Blocked domains apply to whitelisted users too (but not the owner)
+        skip_scan = allowed and (message.author.id == OWNER_ID or not has_blocked_domains(guild_id))
+    if skip_scan:
+        with metrics.timer('on_message.commands'):
+            await bot.process_commands(message)
+        return
+    
+    # Copies of a payload flagged moments ago skip the scan entirely
+    plain = '.' in message.content and not (message.attachments or message.embeds)
+    if plain:
+        fingerprint = (guild_id, payload_fingerprint(message.content))
+        if not allowed:
+            known_links = spam_fingerprints.get(fingerprint)
+            if known_links is not None:
+                metrics.count('duplicate_spam')
+                raid_monitor.record(message)
+                action_queue.submit(message, known_links)
+                return
+    
+    # Check for links the author may not post under the domain rules
+    # One scan feeds both the delete decision and the log embed
+    with metrics.timer('on_message.detect'):
+        detected_links = disallowed_links(guild_id, await scan_message(message), allowed)
+    if detected_links:
+        # Waits only on this message's task while unknown invite codes are fetched
+        with metrics.timer('on_message.invites'):
+            detected_links = await drop_allowed_invites(guild_id, detected_links)
+    if detected_links:
+        metrics.count('links_found', len(detected_links))
+        if plain:
+            spam_fingerprints.put(fingerprint, detected_links)
+        action_queue.submit(message, detected_links)
         return
     
     # Process commands for all users
-    await bot.process_commands(message)
+    with metrics.timer('on_message.commands'):
+        await bot.process_commands(message)
+
+@bot.before_invoke
+async def prepare_command(ctx):
+    ctx.command_started = time.perf_counter()
+    # Commands change whitelists, so the guild's stored entries must be in memory first
+    await load_guild(guild_id_of(ctx.guild))
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    metrics.observe(f"command.{ctx.command.qualified_name}", time.perf_counter() - ctx.command_started)
 
 # OWNER COMMANDS
 
@@ -183,9 +2304,7 @@ async def whitelist_add(ctx, target=None):
     # Try to parse as user
     try:
         user = await commands.UserConverter().convert(ctx, target)
-        if user.id not in bot.whitelist_data["whitelisted_users"]:
-            bot.whitelist_data["whitelisted_users"].append(user.id)
-            save_data(bot.whitelist_data)
+        if set_whitelisted(guild_id_of(ctx.guild), "users", user.id, True):
             
             embed = discord.Embed(
                 title="✅ User Whitelisted",
@@ -220,9 +2339,7 @@ async def whitelist_add(ctx, target=None):
     # Try to parse as role
     try:
         role = await commands.RoleConverter().convert(ctx, target)
-        if role.id not in bot.whitelist_data["whitelisted_roles"]:
-            bot.whitelist_data["whitelisted_roles"].append(role.id)
-            save_data(bot.whitelist_data)
+        if set_whitelisted(guild_id_of(ctx.guild), "roles", role.id, True):
             
             embed = discord.Embed(
                 title="✅ Role Whitelisted",
@@ -252,9 +2369,7 @@ async def whitelist_remove(ctx, target=None):
     # Try to parse as user
     try:
         user = await commands.UserConverter().convert(ctx, target)
-        if user.id in bot.whitelist_data["whitelisted_users"]:
-            bot.whitelist_data["whitelisted_users"].remove(user.id)
-            save_data(bot.whitelist_data)
+        if set_whitelisted(guild_id_of(ctx.guild), "users", user.id, False):
             
             embed = discord.Embed(
                 title="❌ User Removed from Whitelist",
@@ -287,9 +2402,7 @@ async def whitelist_remove(ctx, target=None):
     # Try to parse as role
     try:
         role = await commands.RoleConverter().convert(ctx, target)
-        if role.id in bot.whitelist_data["whitelisted_roles"]:
-            bot.whitelist_data["whitelisted_roles"].remove(role.id)
-            save_data(bot.whitelist_data)
+        if set_whitelisted(guild_id_of(ctx.guild), "roles", role.id, False):
             
             embed = discord.Embed(
                 title="❌ Role Removed from Whitelist",
@@ -306,47 +2419,363 @@ async def whitelist_remove(ctx, target=None):
     except commands.RoleNotFound:
         await ctx.send("❌ Could not find user or role. Please use mentions: `@username` or `@rolename`", delete_after=10)
 
-@bot.command(name='wllist')
+# Durations like "90m", "2h" or "1d12h"
+DURATION_PART = re.compile(r'(\d+)([smhdw])')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def parse_duration(text):
+    """Return a duration in seconds, or None if text isn't one"""
+    text = text.lower()
+    parts = DURATION_PART.findall(text)
+    if not parts or "".join(number + unit for number, unit in parts) != text:
+        return None
+    return sum(int(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+@bot.command(name='wltemp')
+@commands.is_owner()
+async def whitelist_temporary(ctx, target=None, duration=None):
+    """Whitelist a user or role for a limited time (Owner Only)"""
+    seconds = parse_duration(duration) if duration else None
+    if not target or not seconds:
+        await ctx.send("❌ Please give a user or role and a duration: `!wltemp @user 2h` (s/m/h/d/w)", delete_after=10)
+        return
+    if seconds > MAX_GRANT_DURATION:
+        await ctx.send(f"❌ Temporary grants can last at most {MAX_GRANT_DURATION // 86400} days; use `!wladd` for permanent access", delete_after=10)
+        return
+    
+    try:
+        found = await commands.UserConverter().convert(ctx, target)
+        kind = "users"
+    except commands.UserNotFound:
+        try:
+            found = await commands.RoleConverter().convert(ctx, target)
+            kind = "roles"
+        except commands.RoleNotFound:
+            await ctx.send("❌ Could not find user or role. Please use mentions: `@username` or `@rolename`", delete_after=10)
+            return
+    
+    deadline = int(time.time()) + seconds
+    if not grant_temporary(guild_id_of(ctx.guild), kind, found.id, deadline):
+        await ctx.send(f"⚠️ {found.mention} is already permanently whitelisted!", delete_after=5)
+        return
+    
+    embed = discord.Embed(
+        title="⏳ Temporary Whitelist",
+        description=f"{found.mention} can post links until <t:{deadline}:f>.",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="Expires", value=f"<t:{deadline}:R>", inline=True)
+    embed.set_footer(text=f"Added by {ctx.author.name}")
+    await ctx.send(embed=embed)
+
+# Bulk whitelist changes
+# Targets come from mentions, IDs or names in the command and from attached
+# CSV/JSON files. Lookups run concurrently, the whole batch is applied with
+# set_whitelisted_many (one index rebuild, one write batch) and the users
+# are notified through a paced Broadcast.
+TARGET_TOKEN = re.compile(r'<@(?P<mention>[!&]?)(?P<id>\d+)>|(?P<bare>\d{15,20})')
+TARGET_SEPARATORS = re.compile(r'[\s,;]+')
+TARGET_KINDS = {"user": "users", "users": "users", "role": "roles", "roles": "roles"}
+
+def parse_target(token):
+    """Return (kind, ID) for a mention or raw ID, kind None if it could be either"""
+    match = TARGET_TOKEN.fullmatch(token)
+    if not match:
+        return None
+    if match['bare']:
+        return None, int(match['bare'])
+    return ("roles" if match['mention'] == "&" else "users"), int(match['id'])
+
+def parse_import_file(filename, data):
+    """Return (kind, token) pairs from an exported CSV/JSON whitelist or a plain ID list"""
+    text = data.decode('utf-8', errors='replace')
+    pairs = []
+    if filename.lower().endswith('.json'):
+        loaded = json.loads(text)
+        if isinstance(loaded, dict):
+            # Exports and the data file use the whitelisted_* keys
+            for kind in ("users", "roles"):
+                values = loaded.get(ENTRY_KEYS[kind], loaded.get(kind, []))
+                pairs.extend((kind, str(value)) for value in values)
+        else:
+            pairs.extend((None, str(value)) for value in loaded)
+    else:
+        for row in csv.reader(io.StringIO(text)):
+            kind = TARGET_KINDS.get(row[0].strip().lower()) if row else None
+            if kind and len(row) > 1:
+                pairs.append((kind, row[1].strip()))
+            else:
+                pairs.extend((None, cell.strip()) for cell in row)
+    # Headers, names and other columns aren't targets
+    return [(kind, token) for kind, token in pairs if parse_target(token)]
+
+async def resolve_targets(ctx, tokens):
+    """Resolve (kind, token) pairs to (kind, ID) targets concurrently
+
+    Returns the targets and the tokens that matched no user or role.
+    """
+    index = get_permission_index(guild_id_of(ctx.guild))
+    slots = asyncio.Semaphore(BULK_RESOLVE_CONCURRENCY)
+    
+    async def resolve(kind, token):
+        parsed = parse_target(token)
+        if parsed is None:
+            # Names go through the same converters as !wladd
+            for converted_kind, converter in (("users", commands.UserConverter()), ("roles", commands.RoleConverter())):
+                try:
+                    async with slots:
+                        return converted_kind, (await converter.convert(ctx, token)).id
+                except commands.CommandError:
+                    pass
+            return None
+        
+        hint, target_id = parsed
+        kind = kind or hint
+        # Whitelisted IDs need no lookup (and may belong to deleted accounts)
+        for known in ("users", "roles"):
+            if kind in (None, known) and target_id in getattr(index, known):
+                return known, target_id
+        if kind != "users" and ctx.guild and ctx.guild.get_role(target_id):
+            return "roles", target_id
+        if kind == "roles":
+            return None
+        if bot.get_user(target_id) is None:
+            try:
+                async with slots:
+                    await bot.fetch_user(target_id)
+            except discord.HTTPException:
+                return None
+        return "users", target_id
+    
+    tokens = list(dict.fromkeys(tokens))
+    resolved = await asyncio.gather(*(resolve(kind, token) for kind, token in tokens))
+    targets = [target for target in resolved if target]
+    failed = [token for (kind, token), target in zip(tokens, resolved) if not target]
+    return targets, failed
+
+async def bulk_update(ctx, args, whitelisted, usage):
+    """Shared body of !wlbulkadd and !wlbulkremove"""
+    tokens = [(None, token) for token in TARGET_SEPARATORS.split(" ".join(args)) if token]
+    for attachment in ctx.message.attachments:
+        if attachment.size > BULK_IMPORT_MAX_BYTES:
+            await ctx.send(f"❌ `{attachment.filename}` is too large (max {BULK_IMPORT_MAX_BYTES:,} bytes).", delete_after=10)
+            return
+        try:
+            tokens.extend(parse_import_file(attachment.filename, await attachment.read()))
+        except (ValueError, csv.Error) as e:
+            await ctx.send(f"❌ Could not read `{attachment.filename}`: {e}", delete_after=10)
+            return
+    
+    if not tokens:
+        await ctx.send(f"❌ Please give users or roles: `{usage}`, or attach a CSV/JSON file", delete_after=10)
+        return
+    if len(tokens) > BULK_MAX_TARGETS:
+        await ctx.send(f"❌ Too many targets ({len(tokens):,}); the limit is {BULK_MAX_TARGETS:,} per command.", delete_after=10)
+        return
+    
+    status = await ctx.send(f"⏳ Resolving {len(tokens):,} targets...")
+    targets, failed = await resolve_targets(ctx, tokens)
+    changed = set_whitelisted_many(guild_id_of(ctx.guild), targets, whitelisted)
+    
+    users = [target_id for kind, target_id in changed if kind == "users"]
+    roles = len(changed) - len(users)
+    verb = "Added" if whitelisted else "Removed"
+    embed = discord.Embed(
+        title="✅ Bulk Whitelist Update" if whitelisted else "❌ Bulk Whitelist Removal",
+        color=discord.Color.green() if whitelisted else discord.Color.red()
+    )
+    embed.add_field(name=f"{verb} Users", value=str(len(users)), inline=True)
+    embed.add_field(name=f"{verb} Roles", value=str(roles), inline=True)
+    embed.add_field(name="Unchanged", value=str(len(set(targets)) - len(changed)), inline=True)
+    if failed:
+        shown = ", ".join(f"`{truncate(token, 40)}`" for token in failed[:10])
+        more = f" ...and {len(failed) - 10} more" if len(failed) > 10 else ""
+        embed.add_field(name=f"❓ Not Found ({len(failed)})", value=shown + more, inline=False)
+    embed.set_footer(text=f"{verb} by {ctx.author.name}")
+    await status.edit(content=None, embed=embed)
+    if not users:
+        return
+    
+    # Built once and reused for every recipient
+    guild_name = ctx.guild.name if ctx.guild else "every server"
+    if whitelisted:
+        notify_embed = discord.Embed(
+            title="🎉 Whitelist Access Granted",
+            description=f"You have been whitelisted to post links in **{guild_name}**!",
+            color=discord.Color.green()
+        )
+        notify_embed.add_field(name="Granted By", value=ctx.author.mention, inline=True)
+        notify_embed.set_footer(text="You can now post YouTube and Discord links")
+    else:
+        notify_embed = discord.Embed(
+            title="🔒 Whitelist Access Revoked",
+            description=f"Your whitelist access has been removed in **{guild_name}**.",
+            color=discord.Color.red()
+        )
+        notify_embed.add_field(name="Removed By", value=ctx.author.mention, inline=True)
+        notify_embed.set_footer(text="You can no longer post links")
+    
+    async def show_progress(broadcast):
+        try:
+            await status.edit(content=f"📨 Notifying users... {broadcast.done}/{len(users)}")
+        except:
+            pass
+    
+    broadcast = Broadcast(notify_embed, users, BROADCAST_CONCURRENCY, BROADCAST_RETRIES)
+    await broadcast.run(show_progress, BROADCAST_PROGRESS_INTERVAL)
+    try:
+        await status.edit(content=f"📨 Notified {broadcast.success} users ({broadcast.failed} failed)")
+    except:
+        pass
+
+@bot.command(name='wlbulkadd')
 @commands.is_owner()
-async def whitelist_list(ctx):
-    """Show all whitelisted users and roles (Owner Only)"""
-    embed = discord.Embed(
-        title="📋 Whitelist Status",
-        color=discord.Color.blue()
-    )
+async def whitelist_bulk_add(ctx, *targets):
+    """Add many users and roles at once (Owner Only)"""
+    await bulk_update(ctx, targets, True, "!wlbulkadd @user1 @role 123456789012345678")
+
+@bot.command(name='wlbulkremove')
+@commands.is_owner()
+async def whitelist_bulk_remove(ctx, *targets):
+    """Remove many users and roles at once (Owner Only)"""
+    await bulk_update(ctx, targets, False, "!wlbulkremove @user1 @role 123456789012345678")
+
+def export_whitelist(users, roles, file_format):
+    """Serialize sorted user and role IDs as CSV or JSON bytes"""
+    if file_format == "json":
+        return json.dumps({ENTRY_KEYS["users"]: users, ENTRY_KEYS["roles"]: roles}, indent=4).encode()
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(("kind", "id"))
+    writer.writerows(("user", user_id) for user_id in users)
+    writer.writerows(("role", role_id) for role_id in roles)
+    return output.getvalue().encode()
+
+@bot.command(name='wlexport')
+@commands.is_owner()
+async def whitelist_export(ctx, file_format="csv"):
+    """Send the whitelist as a CSV or JSON file (Owner Only)"""
+    file_format = file_format.lower()
+    if file_format not in ("csv", "json"):
+        await ctx.send("❌ Please choose a format: `!wlexport csv` or `!wlexport json`", delete_after=10)
+        return
     
-    # Whitelisted users
-    users_list = []
-    for user_id in bot.whitelist_data["whitelisted_users"]:
+    guild_id = guild_id_of(ctx.guild)
+    users, roles = get_permission_index(guild_id).listing()
+    # Large whitelists serialize on a worker thread; the sorted lists are never mutated
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, export_whitelist, users, roles, file_format)
+    await ctx.send(
+        f"📤 Whitelist export: {len(users)} users, {len(roles)} roles",
+        file=discord.File(io.BytesIO(data), filename=f"whitelist-{guild_id}.{file_format}")
+    )
+
+# Whitelist listing
+# Lines are rendered per page from the index's sorted snapshot, so a page
+# costs the same however large the whitelist is. User lines are keyed by
+# the global scope, role lines by their guild (member counts differ per guild).
+name_cache = DecisionCache(NAME_CACHE_SIZE, NAME_CACHE_TTL)
+
+def user_line(user_id):
+    key = (GLOBAL_GUILD_ID, user_id)
+    line = name_cache.get(key)
+    if line is None:
         user = bot.get_user(user_id)
         if user:
-            users_list.append(f"• {user.mention} (`{user.name}#{user.discriminator}`)")
+            line = f"• {user.mention} (`{user.name}#{user.discriminator}`)"
         else:
-            users_list.append(f"• Unknown User (`{user_id}`)")
-    
-    if users_list:
-        embed.add_field(name="👤 Whitelisted Users", value="\n".join(users_list), inline=False)
-    else:
-        embed.add_field(name="👤 Whitelisted Users", value="None", inline=False)
-    
-    # Whitelisted roles
-    roles_list = []
-    for role_id in bot.whitelist_data["whitelisted_roles"]:
-        role = ctx.guild.get_role(role_id)
+            line = f"• Unknown User (`{user_id}`)"
+        name_cache.put(key, line)
+    return line
+
+def role_line(guild, role_id):
+    key = (guild_id_of(guild), role_id)
+    line = name_cache.get(key)
+    if line is None:
+        role = guild.get_role(role_id) if guild else None
         if role:
-            roles_list.append(f"• {role.mention} (`{role.name}`) - {len(role.members)} members")
+            # role.members walks the whole member list, hence the cache
+            line = f"• {role.mention} (`{truncate(role.name, WLLIST_NAME_LENGTH)}`) - {len(role.members)} members"
         else:
-            roles_list.append(f"• Unknown Role (`{role_id}`)")
-    
-    if roles_list:
-        embed.add_field(name="🎭 Whitelisted Roles", value="\n".join(roles_list), inline=False)
-    else:
-        embed.add_field(name="🎭 Whitelisted Roles", value="None", inline=False)
-    
-    embed.add_field(name="📊 Stats", value=f"**Total Users:** {len(users_list)}\n**Total Roles:** {len(roles_list)}", inline=False)
-    embed.set_footer(text=f"Requested by {ctx.author.name}")
-    
-    await ctx.send(embed=embed)
+            line = f"• Unknown Role (`{role_id}`)"
+        name_cache.put(key, line)
+    return line
+
+WLLIST_TEMPLATE = EmbedTemplate(title="📋 Whitelist Status", color=discord.Color.blue())
+
+class WhitelistPages(discord.ui.View):
+    """Button navigation over a whitelist snapshot, rendering one page at a time"""
+
+    def __init__(self, author, guild, index, page_size=WLLIST_PAGE_SIZE):
+        super().__init__(timeout=WLLIST_TIMEOUT)
+        self.author = author
+        self.guild = guild
+        self.users, self.roles = index.listing()
+        self.page_size = page_size
+        # User pages come first, then role pages
+        self.user_pages = -(-len(self.users) // page_size)
+        self.pages = max(1, self.user_pages - (-len(self.roles) // page_size))
+        self.page = 0
+        self.message = None
+        self.update_buttons()
+
+    def render(self):
+        """Build the embed for the current page"""
+        size = self.page_size
+        if self.page < self.user_pages:
+            start = self.page * size
+            ids = self.users[start:start + size]
+            title, total = "👤 Whitelisted Users", len(self.users)
+            lines = [user_line(user_id) for user_id in ids]
+        else:
+            start = (self.page - self.user_pages) * size
+            ids = self.roles[start:start + size]
+            title, total = "🎭 Whitelisted Roles", len(self.roles)
+            lines = [role_line(self.guild, role_id) for role_id in ids]
+        
+        if ids:
+            fields = [embed_field(f"{title} ({start + 1}-{start + len(ids)} of {total})", "\n".join(lines), False)]
+        else:
+            fields = [embed_field("👤 Whitelisted Users", "None", False), embed_field("🎭 Whitelisted Roles", "None", False)]
+        fields.append(embed_field("📊 Stats", f"**Total Users:** {len(self.users)}\n**Total Roles:** {len(self.roles)}", False))
+        return WLLIST_TEMPLATE.render(fields, footer=f"Page {self.page + 1}/{self.pages} • Requested by {self.author.name}")
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author.id
+
+    async def turn(self, interaction, step):
+        self.page = min(max(self.page + step, 0), self.pages - 1)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="◀ Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label="Next ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.turn(interaction, 1)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+@bot.command(name='wllist')
+@commands.is_owner()
+async def whitelist_list(ctx):
+    """Show all whitelisted users and roles, one page at a time (Owner Only)"""
+    pages = WhitelistPages(ctx.author, ctx.guild, get_permission_index(guild_id_of(ctx.guild)))
+    if pages.pages == 1:
+        await ctx.send(embed=pages.render())
+        return
+    pages.message = await ctx.send(embed=pages.render(), view=pages)
 
 @bot.command(name='wlcheck')
 @commands.is_owner()
@@ -374,17 +2803,17 @@ async def whitelist_check(ctx, target=None):
         sources = []
         if user.id == OWNER_ID:
             sources.append("👑 Bot Owner")
-        if user.id in bot.whitelist_data["whitelisted_users"]:
-            sources.append("👤 Direct Whitelist")
+        index = get_permission_index(guild_id_of(ctx.guild))
+        if user.id in index.users:
+            deadline = grant_deadline(guild_id_of(ctx.guild), "users", user.id)
+            sources.append(f"👤 Direct Whitelist (expires <t:{deadline}:R>)" if deadline else "👤 Direct Whitelist")
         
         # Check roles
-        user_role_ids = [role.id for role in user.roles]
         whitelisted_roles = []
-        for role_id in bot.whitelist_data["whitelisted_roles"]:
-            if role_id in user_role_ids:
-                role = ctx.guild.get_role(role_id)
-                if role:
-                    whitelisted_roles.append(role.name)
+        for role_id in index.matching_roles(user):
+            role = ctx.guild.get_role(role_id)
+            if role:
+                whitelisted_roles.append(role.name)
         
         if whitelisted_roles:
             sources.append(f"🎭 Role(s): {', '.join(whitelisted_roles)}")
@@ -399,7 +2828,7 @@ async def whitelist_check(ctx, target=None):
     # Try user first
     try:
         user = await commands.UserConverter().convert(ctx, target)
-        if is_allowed(user):
+        if is_allowed(user, ctx.guild):
             status = "✅ Whitelisted"
             color = discord.Color.green()
         else:
@@ -413,6 +2842,9 @@ async def whitelist_check(ctx, target=None):
         )
         embed.add_field(name="Status", value=status, inline=True)
         embed.add_field(name="Username", value=f"`{user.name}#{user.discriminator}`", inline=True)
+        deadline = grant_deadline(guild_id_of(ctx.guild), "users", user.id)
+        if deadline:
+            embed.add_field(name="Expires", value=f"<t:{deadline}:R>", inline=True)
         
         await ctx.send(embed=embed)
         return
@@ -423,7 +2855,7 @@ async def whitelist_check(ctx, target=None):
     # Try role
     try:
         role = await commands.RoleConverter().convert(ctx, target)
-        if role.id in bot.whitelist_data["whitelisted_roles"]:
+        if role.id in get_permission_index(guild_id_of(ctx.guild)).roles:
             status = "✅ Whitelisted"
             color = discord.Color.green()
         else:
@@ -438,6 +2870,9 @@ async def whitelist_check(ctx, target=None):
         embed.add_field(name="Status", value=status, inline=True)
         embed.add_field(name="Role Name", value=role.name, inline=True)
         embed.add_field(name="Members", value=str(len(role.members)), inline=True)
+        deadline = grant_deadline(guild_id_of(ctx.guild), "roles", role.id)
+        if deadline:
+            embed.add_field(name="Expires", value=f"<t:{deadline}:R>", inline=True)
         
         await ctx.send(embed=embed)
         return
@@ -449,13 +2884,14 @@ async def whitelist_check(ctx, target=None):
 @commands.is_owner()
 async def whitelist_dm_all(ctx):
     """DM all whitelisted users (Owner Only)"""
-    if not bot.whitelist_data["whitelisted_users"]:
+    user_ids = whitelisted_ids(guild_id_of(ctx.guild), "users")
+    if not user_ids:
         await ctx.send("❌ No whitelisted users to DM.", delete_after=5)
         return
     
     confirm = await ctx.send(
         f"⚠️ **Confirm DM Broadcast**\n"
-        f"This will DM {len(bot.whitelist_data['whitelisted_users'])} whitelisted users.\n\n"
+        f"This will DM {len(user_ids)} whitelisted users.\n\n"
         f"React with ✅ to proceed or ❌ to cancel."
     )
     
@@ -469,36 +2905,34 @@ async def whitelist_dm_all(ctx):
         reaction, user = await bot.wait_for('reaction_add', timeout=30.0, check=check)
         
         if str(reaction.emoji) == '✅':
-            await confirm.edit(content="📨 Sending DMs...")
+            await confirm.edit(content=f"📨 Sending DMs... 0/{len(user_ids)}")
+            
+            # Built once and reused for every recipient
+            embed = discord.Embed(
+                title="📢 Whitelist Announcement",
+                description=f"This is a message to all whitelisted users in **{ctx.guild.name}**.",
+                color=discord.Color.blue()
+            )
+            embed.add_field(name="Reminder", value="You are whitelisted to post links in this server.", inline=False)
+            embed.add_field(name="Allowed Links", value="• YouTube videos\n• Discord invites\n• All website links", inline=False)
+            embed.set_footer(text="From server administration")
             
-            success = 0
-            failed = 0
+            async def show_progress(broadcast):
+                try:
+                    await confirm.edit(
+                        content=f"📨 Sending DMs... {broadcast.done}/{len(user_ids)}\n"
+                               f"Success: {broadcast.success} | Failed: {broadcast.failed}"
+                    )
+                except:
+                    pass
             
-            for user_id in bot.whitelist_data["whitelisted_users"]:
-                user = bot.get_user(user_id)
-                if user:
-                    try:
-                        embed = discord.Embed(
-                            title="📢 Whitelist Announcement",
-                            description=f"This is a message to all whitelisted users in **{ctx.guild.name}**.",
-                            color=discord.Color.blue()
-                        )
-                        embed.add_field(name="Reminder", value="You are whitelisted to post links in this server.", inline=False)
-                        embed.add_field(name="Allowed Links", value="• YouTube videos\n• Discord invites\n• All website links", inline=False)
-                        embed.set_footer(text="From server administration")
-                        await user.send(embed=embed)
-                        success += 1
-                    except:
-                        failed += 1
-                else:
-                    failed += 1
-                
-                await asyncio.sleep(1)  # Rate limit protection
+            broadcast = Broadcast(embed, user_ids, BROADCAST_CONCURRENCY, BROADCAST_RETRIES)
+            await broadcast.run(show_progress, BROADCAST_PROGRESS_INTERVAL)
             
             await confirm.edit(
                 content=f"✅ DM Broadcast Complete!\n"
-                       f"Success: {success} users\n"
-                       f"Failed: {failed} users"
+                       f"Success: {broadcast.success} users\n"
+                       f"Failed: {broadcast.failed} users"
             )
         else:
             await confirm.edit(content="❌ DM broadcast cancelled.")
@@ -506,6 +2940,131 @@ async def whitelist_dm_all(ctx):
     except asyncio.TimeoutError:
         await confirm.edit(content="⏰ DM broadcast timed out.")
 
+async def update_domain_rule(ctx, domain, allowed, usage):
+    """Shared body of !domainallow, !domainblock and !domainremove"""
+    rule = normalize_domain_rule(domain) if domain else None
+    if not rule:
+        await ctx.send(f"❌ Please give a domain: `{usage}` (use `*.example.com` to include subdomains)", delete_after=10)
+        return
+    
+    if not set_domain_rule(guild_id_of(ctx.guild), rule, allowed):
+        await ctx.send(f"⚠️ No change: `{rule}` already has that rule!", delete_after=5)
+        return
+    
+    if allowed is None:
+        embed = discord.Embed(
+            title="🗑️ Domain Rule Removed",
+            description=f"`{rule}` follows the normal whitelist again.",
+            color=discord.Color.blue()
+        )
+    elif allowed:
+        embed = discord.Embed(
+            title="✅ Domain Allowed",
+            description=f"Anyone can now post links to `{rule}`.",
+            color=discord.Color.green()
+        )
+    else:
+        embed = discord.Embed(
+            title="⛔ Domain Blocked",
+            description=f"Links to `{rule}` will be deleted, even from whitelisted users.",
+            color=discord.Color.red()
+        )
+    embed.set_footer(text=f"Changed by {ctx.author.name}")
+    await ctx.send(embed=embed)
+
+@bot.command(name='domainallow')
+@commands.is_owner()
+async def domain_allow(ctx, domain=None):
+    """Let everyone post links to a domain (Owner Only)"""
+    await update_domain_rule(ctx, domain, True, "!domainallow docs.example.com")
+
+@bot.command(name='domainblock')
+@commands.is_owner()
+async def domain_block(ctx, domain=None):
+    """Delete links to a domain even from whitelisted users (Owner Only)"""
+    await update_domain_rule(ctx, domain, False, "!domainblock example.com")
+
+@bot.command(name='domainremove')
+@commands.is_owner()
+async def domain_remove(ctx, domain=None):
+    """Remove a domain rule (Owner Only)"""
+    await update_domain_rule(ctx, domain, None, "!domainremove example.com")
+
+@bot.command(name='domainlist')
+@commands.is_owner()
+async def domain_list(ctx):
+    """Show this server's allowed and blocked domains (Owner Only)"""
+    embed = discord.Embed(
+        title="🌐 Domain Rules",
+        color=discord.Color.blue()
+    )
+    
+    guild_id = guild_id_of(ctx.guild)
+    for kind, title in (("allowed", "✅ Allowed Domains"), ("blocked", "⛔ Blocked Domains")):
+        rules = [f"`{rule}`" for rule in domain_rules(guild_id, kind)]
+        if guild_id != GLOBAL_GUILD_ID:
+            rules += [f"`{rule}` (global)" for rule in domain_rules(GLOBAL_GUILD_ID, kind)]
+        lines = [f"• {rule}" for rule in rules[:20]]
+        if len(rules) > 20:
+            lines.append(f"...and {len(rules) - 20} more")
+        embed.add_field(name=title, value="\n".join(lines) or "None", inline=False)
+    
+    embed.set_footer(text=f"Requested by {ctx.author.name}")
+    await ctx.send(embed=embed)
+
+@bot.command(name='cachestats')
+@commands.is_owner()
+async def cache_stats(ctx):
+    """Show permission cache hit/miss counters (Owner Only)"""
+    embed = discord.Embed(
+        title="🗃️ Permission Cache",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="Hits", value=str(decision_cache.hits), inline=True)
+    embed.add_field(name="Misses", value=str(decision_cache.misses), inline=True)
+    embed.add_field(name="Hit Rate", value=f"{decision_cache.hit_rate():.1%}", inline=True)
+    embed.add_field(name="Entries", value=f"{len(decision_cache.entries)}/{decision_cache.maxsize}", inline=True)
+    embed.add_field(name="TTL", value=f"{decision_cache.ttl}s", inline=True)
+    invite_cache = invite_resolver.cache
+    embed.add_field(
+        name="Invite Cache",
+        value=f"{len(invite_cache.entries)}/{invite_cache.maxsize} codes, {invite_cache.hit_rate():.1%} hits, "
+              f"{metrics.counters['invite_fetches']} fetches",
+        inline=False
+    )
+    embed.set_footer(text=f"Requested by {ctx.author.name}")
+    
+    await ctx.send(embed=embed)
+
+@bot.command(name='stats')
+@commands.is_owner()
+async def show_stats(ctx):
+    """Show hot-path latency percentiles and counters (Owner Only)"""
+    embed = discord.Embed(
+        title="📈 Bot Stats",
+        color=discord.Color.blue()
+    )
+    
+    counters = metrics.counters
+    embed.add_field(name="💬 Messages Seen", value=str(counters['messages_seen']), inline=True)
+    embed.add_field(name="🔗 Links Found", value=str(counters['links_found']), inline=True)
+    embed.add_field(name="🗑️ Deletions", value=str(counters['messages_deleted']), inline=True)
+    embed.add_field(name="📭 DM Failures", value=str(counters['dm_failures']), inline=True)
+    embed.add_field(name="⏳ Timeouts", value=str(counters['timeouts']), inline=True)
+    embed.add_field(name="🗃️ Cache Hit Rate", value=f"{decision_cache.hit_rate():.1%}", inline=True)
+    
+    # Busiest stages first; keep the table inside the 1024 character field limit
+    stages = sorted(metrics.histograms.items(), key=lambda item: item[1].count, reverse=True)[:12]
+    rows = [f"{'stage':<22}{'n':>7}{'p50':>8}{'p95':>8}{'p99':>8}"]
+    for stage, histogram in stages:
+        p50, p95, p99 = (histogram.percentile(fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+        rows.append(f"{stage[:22]:<22}{histogram.count:>7}{p50:>8.2f}{p95:>8.2f}{p99:>8.2f}")
+    embed.add_field(name="⏱️ Latency (ms)", value="```" + "\n".join(rows) + "```", inline=False)
+    if METRICS_PORT:
+        embed.set_footer(text=f"Prometheus: http://{METRICS_HOST}:{metrics_port()}/metrics")
+    
+    await ctx.send(embed=embed)
+
 # PUBLIC COMMANDS
 
 @bot.command(name='request')
@@ -515,242 +3074,516 @@ async def request_whitelist(ctx, *, reason=None):
         await ctx.send("✅ You are already whitelisted! You can post links.", delete_after=10)
         return
     
-    # Find the owner to notify
-    owner = bot.get_user(OWNER_ID)
-    if not owner:
-        await ctx.send("❌ Could not notify owner. Please contact them directly.", delete_after=10)
+    guild_id = guild_id_of(ctx.guild)
+    retry_at = request_queue.retry_at((guild_id, ctx.author.id))
+    if retry_at:
+        await ctx.send(f"⏳ You already sent a request. You can send another <t:{retry_at}:R>.", delete_after=10)
         return
     
-    # Send request to owner
-    request_embed = discord.Embed(
-        title="🔔 Whitelist Request",
-        description=f"**From:** {ctx.author.mention} (`{ctx.author.name}#{ctx.author.discriminator}`)",
-        color=discord.Color.orange(),
-        timestamp=datetime.utcnow()
-    )
-    request_embed.add_field(name="Server", value=ctx.guild.name, inline=True)
-    request_embed.add_field(name="Channel", value=ctx.channel.mention, inline=True)
+    if reason:
+        reason = truncate(reason, REQUEST_REASON_LIMIT)
+    # The owner hears about it in the next digest
+    new = request_queue.submit(guild_id, ctx.author.id, ctx.channel.id, reason)
     
+    # Confirm to user
+    confirm_embed = discord.Embed(
+        title="✅ Request Sent" if new else "📝 Request Updated",
+        description="Your whitelist request has been sent to the bot owner." if new
+                    else "You already have a pending request; it has been updated.",
+        color=discord.Color.green()
+    )
     if reason:
-        request_embed.add_field(name="Reason", value=reason, inline=False)
+        confirm_embed.add_field(name="Your Reason", value=reason, inline=False)
+    confirm_embed.set_footer(text="You will be notified if approved")
     
-    request_embed.add_field(name="Quick Actions", 
-                           value=f"Add: `!wladd {ctx.author.mention}`\nCheck: `!wlcheck {ctx.author.mention}`", 
-                           inline=False)
-    request_embed.set_footer(text=f"User ID: {ctx.author.id}")
+    await ctx.send(embed=confirm_embed, delete_after=30)
+    if not new:
+        return
     
+    # Send DM confirmation to user
     try:
-        await owner.send(embed=request_embed)
-        
-        # Confirm to user
-        confirm_embed = discord.Embed(
-            title="✅ Request Sent",
-            description="Your whitelist request has been sent to the bot owner.",
-            color=discord.Color.green()
+        user_dm = discord.Embed(
+            title="📨 Whitelist Request Submitted",
+            description=f"Your request to post links in **{ctx.guild.name if ctx.guild else 'every server'}** has been submitted.",
+            color=discord.Color.blue()
         )
-        if reason:
-            confirm_embed.add_field(name="Your Reason", value=reason, inline=False)
-        confirm_embed.set_footer(text="You will be notified if approved")
-        
-        await ctx.send(embed=confirm_embed, delete_after=30)
-        
-        # Send DM confirmation to user
+        await ctx.author.send(embed=user_dm)
+    except:
+        pass
+
+def request_line(guild_id, record):
+    """One pending request, as shown in digests and !wlrequests"""
+    user_id, requested_at, channel_id, reason, count = record
+    guild = bot.get_guild(guild_id)
+    where = f"**{guild.name}**" if guild else ("DMs" if guild_id == GLOBAL_GUILD_ID else f"`{guild_id}`")
+    repeats = f" (x{count})" if count > 1 else ""
+    line = f"• <@{user_id}> in {where} <t:{requested_at}:R>{repeats}"
+    if reason:
+        line += f": {truncate(reason, 80)}"
+    return line
+
+def request_lines(requests, limit):
+    """Request lines that fit one embed description"""
+    lines = [request_line(guild_id, record) for guild_id, record in requests[:limit]]
+    if len(requests) > limit:
+        lines.append(f"...and {len(requests) - limit} more")
+    return "\n".join(lines)
+
+REQUEST_REVIEW_FIELD = embed_field(
+    "Review",
+    "`!wlrequests` - List pending requests\n"
+    "`!wlapprove <users|all>` - Approve and whitelist\n"
+    "`!wldeny <users|all>` - Deny",
+    False
+)
+
+async def send_request_digest(keys):
+    """DM the owner one embed covering every request since the last digest"""
+    # Taken before awaiting anything: requests answered meanwhile just drop out
+    requests = [(key[0], request_queue.pending[key]) for key in keys if key in request_queue.pending]
+    if not requests:
+        return
+    owner = bot.get_user(OWNER_ID) or await bot.fetch_user(OWNER_ID)
+    embed = discord.Embed(
+        title=f"🔔 {len(requests)} New Whitelist Request(s)",
+        description=request_lines(requests, 20),
+        color=discord.Color.orange(),
+        timestamp=datetime.utcnow()
+    )
+    add_fields(embed, [REQUEST_REVIEW_FIELD])
+    embed.set_footer(text=f"{len(request_queue.pending)} pending in total")
+    await owner.send(embed=embed)
+
+async def load_request_guilds(ctx):
+    """Load every guild with stored requests when a review starts in DMs
+
+    Sharded processes only hold their own guilds, but the owner's DMs reach
+    one process; reviews there must see every process's requests.
+    """
+    if ctx.guild or not getattr(storage, 'publish', False):
+        return
+    loop = asyncio.get_running_loop()
+    guild_ids = await loop.run_in_executor(None, storage.request_guilds)
+    await asyncio.gather(*(load_guild(guild_id) for guild_id in guild_ids))
+
+def select_requests(ctx, args):
+    """Pending request keys matching "all" or the given users, in this server (or every server from DMs)"""
+    keys = [key for key in request_queue.pending if not ctx.guild or key[0] == ctx.guild.id]
+    if [arg.lower() for arg in args] == ["all"]:
+        return keys
+    user_ids = set()
+    for token in TARGET_SEPARATORS.split(" ".join(args)):
+        target = parse_target(token) if token else None
+        if target:
+            user_ids.add(target[1])
+    return [key for key in keys if key[1] in user_ids]
+
+@bot.command(name='wlrequests')
+@commands.is_owner()
+async def list_requests(ctx):
+    """Show pending whitelist requests, oldest first (Owner Only)"""
+    await load_request_guilds(ctx)
+    keys = select_requests(ctx, ["all"])
+    requests = sorted(((key[0], request_queue.pending[key]) for key in keys), key=lambda request: request[1][1])
+    embed = discord.Embed(
+        title=f"📬 Pending Requests ({len(requests)})",
+        description=request_lines(requests, 20) or "No pending requests.",
+        color=discord.Color.blue()
+    )
+    if requests:
+        add_fields(embed, [REQUEST_REVIEW_FIELD])
+    embed.set_footer(text=f"Requested by {ctx.author.name}")
+    await ctx.send(embed=embed)
+
+async def review_requests(ctx, args, approved):
+    """Shared body of !wlapprove and !wldeny"""
+    await load_request_guilds(ctx)
+    keys = select_requests(ctx, args)
+    if not keys:
+        await ctx.send("❌ No matching pending requests. Use `!wlrequests` to list them.", delete_after=10)
+        return
+    
+    closed = request_queue.close(keys)
+    by_guild = {}
+    for guild_id, record in closed:
+        by_guild.setdefault(guild_id, []).append(record[0])
+    whitelisted = 0
+    if approved:
+        # One batch per server: one index rebuild and one write each
+        for guild_id, user_ids in by_guild.items():
+            whitelisted += len(set_whitelisted_many(guild_id, [("users", user_id) for user_id in user_ids], True))
+    
+    verb = "Approved" if approved else "Denied"
+    summary = f"{'✅' if approved else '❌'} {verb} {len(closed)} request(s)"
+    if approved:
+        summary += f", {whitelisted} newly whitelisted"
+    status = await ctx.send(summary)
+    
+    # Notify through the paced sender, one embed per server
+    success = failed = 0
+    
+    async def show_progress(broadcast):
         try:
-            user_dm = discord.Embed(
-                title="📨 Whitelist Request Submitted",
-                description=f"Your request to post links in **{ctx.guild.name}** has been submitted.",
-                color=discord.Color.blue()
-            )
-            await ctx.author.send(embed=user_dm)
+            await status.edit(content=f"{summary}\n📨 Notifying users... {success + failed + broadcast.done}/{len(closed)}")
         except:
             pass
-            
+    
+    for guild_id, user_ids in by_guild.items():
+        guild = bot.get_guild(guild_id)
+        if guild is None and guild_id != GLOBAL_GUILD_ID:
+            # A guild on another process's shards
+            try:
+                guild = await bot.fetch_guild(guild_id)
+            except Exception as e:
+                print(f"Error fetching guild {guild_id}: {e}")
+        guild_name = guild.name if guild else ("every server" if guild_id == GLOBAL_GUILD_ID else f"server {guild_id}")
+        if approved:
+            notify_embed = discord.Embed(
+                title="🎉 Whitelist Access Granted",
+                description=f"Your request was approved. You can now post links in **{guild_name}**!",
+                color=discord.Color.green()
+            )
+            notify_embed.set_footer(text="You can now post YouTube and Discord links")
+        else:
+            notify_embed = discord.Embed(
+                title="🔒 Whitelist Request Denied",
+                description=f"Your request to post links in **{guild_name}** was denied.",
+                color=discord.Color.red()
+            )
+        broadcast = Broadcast(notify_embed, user_ids, BROADCAST_CONCURRENCY, BROADCAST_RETRIES)
+        await broadcast.run(show_progress, BROADCAST_PROGRESS_INTERVAL)
+        success += broadcast.success
+        failed += broadcast.failed
+    try:
+        await status.edit(content=f"{summary}\n📨 Notified {success} users ({failed} failed)")
     except:
-        await ctx.send("❌ Failed to send request to owner. They may have DMs disabled.", delete_after=10)
+        pass
+
+@bot.command(name='wlapprove')
+@commands.is_owner()
+async def approve_requests(ctx, *users):
+    """Approve pending requests and whitelist the requesters (Owner Only)"""
+    await review_requests(ctx, users, True)
+
+@bot.command(name='wldeny')
+@commands.is_owner()
+async def deny_requests(ctx, *users):
+    """Deny pending requests (Owner Only)"""
+    await review_requests(ctx, users, False)
+
+STATUS_APPROVED_TEMPLATE = EmbedTemplate(
+    title="✅ Whitelist Status: APPROVED",
+    description="You can post links in this server!",
+    color=discord.Color.green(),
+    fields=[
+        ("✅ Allowed Links", "• YouTube videos\n• Discord invites\n• All website URLs\n• Twitch links\n• Social media links", False)
+    ]
+)
+STATUS_DENIED_TEMPLATE = EmbedTemplate(
+    title="❌ Whitelist Status: NOT APPROVED",
+    description="You cannot post links in this server.",
+    color=discord.Color.red(),
+    fields=[
+        ("How to Get Access", "Use `!request <reason>` to ask the owner for permission.\nExample: `!request I need to share tutorial videos`", False),
+        ("❌ Blocked Links", "• All URLs\n• Discord invites\n• YouTube links\n• Website links", False)
+    ]
+)
 
 @bot.command(name='mystatus')
 async def my_status(ctx):
     """Check your whitelist status"""
+    footer = f"Requested by {ctx.author.name}"
     if is_allowed(ctx.author):
-        embed = discord.Embed(
-            title="✅ Whitelist Status: APPROVED",
-            description="You can post links in this server!",
-            color=discord.Color.green()
-        )
-        
-        # Show what you can post
-        embed.add_field(
-            name="✅ Allowed Links",
-            value="• YouTube videos\n• Discord invites\n• All website URLs\n• Twitch links\n• Social media links",
-            inline=False
-        )
-        
         # Show source
         sources = []
         if ctx.author.id == OWNER_ID:
             sources.append("👑 You are the bot owner")
-        if ctx.author.id in bot.whitelist_data["whitelisted_users"]:
+        index = get_permission_index(guild_id_of(ctx.guild))
+        if ctx.author.id in index.users:
             sources.append("👤 You are directly whitelisted")
         
         # Check roles
-        user_role_ids = [role.id for role in ctx.author.roles]
         whitelisted_roles = []
-        for role_id in bot.whitelist_data["whitelisted_roles"]:
-            if role_id in user_role_ids:
-                role = ctx.guild.get_role(role_id)
-                if role:
-                    whitelisted_roles.append(role.name)
+        for role_id in index.matching_roles(ctx.author):
+            role = ctx.guild.get_role(role_id)
+            if role:
+                whitelisted_roles.append(role.name)
         
         if whitelisted_roles:
             sources.append(f"🎭 You have whitelisted role(s): {', '.join(whitelisted_roles)}")
         
+        fields = STATUS_APPROVED_TEMPLATE.fields
         if sources:
-            embed.add_field(name="Access Source", value="\n".join(sources), inline=False)
-        
+            fields = [*fields, embed_field("Access Source", "\n".join(sources), False)]
+        embed = STATUS_APPROVED_TEMPLATE.render(fields, footer=footer)
     else:
-        embed = discord.Embed(
-            title="❌ Whitelist Status: NOT APPROVED",
-            description="You cannot post links in this server.",
-            color=discord.Color.red()
-        )
-        embed.add_field(
-            name="How to Get Access",
-            value="Use `!request <reason>` to ask the owner for permission.\nExample: `!request I need to share tutorial videos`",
-            inline=False
-        )
-        embed.add_field(
-            name="❌ Blocked Links",
-            value="• All URLs\n• Discord invites\n• YouTube links\n• Website links",
-            inline=False
-        )
+        embed = STATUS_DENIED_TEMPLATE.render(footer=footer)
     
-    embed.set_footer(text=f"Requested by {ctx.author.name}")
     await ctx.send(embed=embed, delete_after=30)
 
+# Help embeds per audience; only the footer changes between calls
+OWNER_HELP_TEMPLATE = EmbedTemplate(
+    title="🛡️ Owner Commands",
+    description="Bot owner commands",
+    color=discord.Color.gold(),
+    fields=[
+        ("👥 Whitelist Management",
+         "• `!wladd @user` - Add user to whitelist\n"
+         "• `!wlremove @user` - Remove user\n"
+         "• `!wltemp @user 2h` - Whitelist for a limited time\n"
+         "• `!wllist` - Show all whitelisted\n"
+         "• `!wlcheck @user` - Check status\n"
+         "• `!wlbulkadd <targets>` - Add many users/roles (mentions, IDs or a CSV/JSON file)\n"
+         "• `!wlbulkremove <targets>` - Remove many users/roles\n"
+         "• `!wlexport [csv|json]` - Download the whitelist\n"
+         "• `!wlrequests` - Pending access requests\n"
+         "• `!wlapprove <users|all>` / `!wldeny <users|all>` - Answer requests\n"
+         "• `!wldm` - DM all whitelisted users\n"
+         "• `!domainallow <domain>` - Allow a domain for everyone\n"
+         "• `!domainblock <domain>` - Block a domain for everyone\n"
+         "• `!domainremove <domain>` - Remove a domain rule\n"
+         "• `!domainlist` - Show domain rules\n"
+         "• `!cachestats` - Permission cache stats\n"
+         "• `!stats` - Latency and moderation stats",
+         False),
+        ("🧹 Moderation",
+         "• `!clean [limit]` - Clean links in this channel\n"
+         "• `!cleanserver [limit]` - Clean links in every channel",
+         False),
+        ("📊 Information",
+         "• `!mystatus` - Check your status\n"
+         "• `!help` - Show this help",
+         False)
+    ]
+)
+WHITELISTED_HELP_TEMPLATE = EmbedTemplate(
+    title="✅ Whitelisted User Commands",
+    description="You can post links!",
+    color=discord.Color.green(),
+    fields=[
+        ("✅ You Can Post", "• YouTube links\n• Discord invites\n• All website URLs\n• Social media links", False),
+        ("📊 Information",
+         "• `!mystatus` - Check your status\n"
+         "• `!request <reason>` - Request for others\n"
+         "• `!help` - Show help",
+         False)
+    ]
+)
+RESTRICTED_HELP_TEMPLATE = EmbedTemplate(
+    title="🔒 Restricted Access",
+    description="You cannot post links in this server.",
+    color=discord.Color.red(),
+    fields=[
+        ("❌ Blocked Content", "• All URLs and website links\n• YouTube videos\n• Discord invites\n• Social media links", False),
+        ("📋 Available Commands",
+         "• `!request <reason>` - Request whitelist access\n"
+         "• `!mystatus` - Check your status\n"
+         "• `!help` - Show this help",
+         False),
+        ("ℹ️ How to Get Access",
+         "Use `!request <reason>` to ask the owner.\nExample: `!request I need to share my YouTube tutorials`",
+         False)
+    ]
+)
+
 @bot.command(name='help')
 async def help_command(ctx):
     """Show help information"""
     if ctx.author.id == OWNER_ID:
-        # Owner help
-        embed = discord.Embed(
-            title="🛡️ Owner Commands",
-            description="Bot owner commands",
-            color=discord.Color.gold()
-        )
-        
-        embed.add_field(
-            name="👥 Whitelist Management",
-            value="• `!wladd @user` - Add user to whitelist\n"
-                  "• `!wlremove @user` - Remove user\n"
-                  "• `!wllist` - Show all whitelisted\n"
-                  "• `!wlcheck @user` - Check status\n"
-                  "• `!wldm` - DM all whitelisted users",
-            inline=False
-        )
-        
-        embed.add_field(
-            name="📊 Information",
-            value="• `!mystatus` - Check your status\n"
-                  "• `!help` - Show this help",
-            inline=False
-        )
-        
-        embed.set_footer(text=f"Bot Owner: {ctx.author.name}")
-        
+        embed = OWNER_HELP_TEMPLATE.render(footer=f"Bot Owner: {ctx.author.name}")
     elif is_allowed(ctx.author):
-        # Whitelisted user help
-        embed = discord.Embed(
-            title="✅ Whitelisted User Commands",
-            description="You can post links!",
-            color=discord.Color.green()
-        )
-        
-        embed.add_field(
-            name="✅ You Can Post",
-            value="• YouTube links\n• Discord invites\n• All website URLs\n• Social media links",
-            inline=False
-        )
-        
-        embed.add_field(
-            name="📊 Information",
-            value="• `!mystatus` - Check your status\n"
-                  "• `!request <reason>` - Request for others\n"
-                  "• `!help` - Show help",
-            inline=False
-        )
-        
-        embed.set_footer(text=f"Whitelisted User: {ctx.author.name}")
-        
+        embed = WHITELISTED_HELP_TEMPLATE.render(footer=f"Whitelisted User: {ctx.author.name}")
     else:
-        # Regular user help
-        embed = discord.Embed(
-            title="🔒 Restricted Access",
-            description="You cannot post links in this server.",
-            color=discord.Color.red()
-        )
-        
-        embed.add_field(
-            name="❌ Blocked Content",
-            value="• All URLs and website links\n• YouTube videos\n• Discord invites\n• Social media links",
-            inline=False
-        )
-        
-        embed.add_field(
-            name="📋 Available Commands",
-            value="• `!request <reason>` - Request whitelist access\n"
-                  "• `!mystatus` - Check your status\n"
-                  "• `!help` - Show this help",
-            inline=False
-        )
-        
-        embed.add_field(
-            name="ℹ️ How to Get Access",
-            value="Use `!request <reason>` to ask the owner.\nExample: `!request I need to share my YouTube tutorials`",
-            inline=False
-        )
+        embed = RESTRICTED_HELP_TEMPLATE.render()
     
     await ctx.send(embed=embed, delete_after=30)
 
 # MODERATION COMMANDS (Owner only)
 
+class CleanStats:
+    """Running counts for a !clean run"""
+
+    def __init__(self):
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.started = time.perf_counter()
+
+    def throughput(self):
+        elapsed = time.perf_counter() - self.started
+        return self.scanned / elapsed if elapsed else 0.0
+
+async def clean_channel(channel, limit, stats):
+    """Scan up to limit messages in channel and delete non-whitelisted links"""
+    cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+    recent = []
+    old = []
+    candidates = []
+    blocking = has_blocked_domains(channel.guild.id)
+    
+    async def settle():
+        """Sort the candidates into recent and old once their invites are resolved"""
+        nonlocal recent
+        # One batch of invite fetches per page instead of one per message
+        await invite_resolver.resolve([
+            invite_code(match.link) for message, links in candidates for match in links if match.category == 'invite'
+        ])
+        for message, links in candidates:
+            if not await drop_allowed_invites(channel.guild.id, links):
+                continue
+            stats.matched += 1
+            if message.created_at > cutoff:
+                recent.append(message)
+                if len(recent) == 100:
+                    deleted = await delete_messages(channel, recent)
+                    stats.deleted += len(deleted)
+                    recent = []
+            else:
+                old.append(message)
+        candidates.clear()
+    
+    # history() pages through the channel 100 messages per request
+    async for message in channel.history(limit=limit):
+        stats.scanned += 1
+        
+        # Skip bot messages, the owner and allowed users (unless domains are blocked)
+        if message.author.bot or message.author.id == OWNER_ID:
+            continue
+        allowed = is_allowed(message.author, channel.guild)
+        if allowed and not blocking:
+            continue
+        links = disallowed_links(channel.guild.id, await scan_message(message), allowed)
+        if links:
+            candidates.append((message, links))
+            if len(candidates) == 100:
+                await settle()
+    await settle()
+    
+    if recent:
+        # Await first: stats is shared by concurrent channel sweeps
+        deleted = await delete_messages(channel, recent)
+        stats.deleted += len(deleted)
+    # Too old for bulk delete, so these go one at a time
+    for message in old:
+        try:
+            await message.delete()
+            stats.deleted += 1
+            metrics.count('messages_deleted')
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            print(f"Error: {e}")
+
 @bot.command(name='clean')
 @commands.is_owner()
 async def clean_links(ctx, limit: int = 50):
     """Clean up non-whitelisted links (Owner Only)"""
-    if limit > 100:
-        limit = 100
+    if limit > CLEAN_MAX_MESSAGES:
+        limit = CLEAN_MAX_MESSAGES
     
     processing = await ctx.send(f"🧹 Cleaning up to {limit} messages...")
     
-    deleted_count = 0
-    async for message in ctx.channel.history(limit=limit):
-        # Skip bot messages and allowed users
-        if message.author.bot or is_allowed(message.author):
-            continue
-        
-        if contains_links(message.content):
-            try:
-                await message.delete()
-                deleted_count += 1
-                await asyncio.sleep(0.5)  # Rate limit protection
-            except:
-                pass
+    stats = CleanStats()
+    await clean_channel(ctx.channel, limit, stats)
     
     await processing.delete()
     
     embed = discord.Embed(
         title="🧹 Cleanup Complete",
-        color=discord.Color.green() if deleted_count == 0 else discord.Color.orange()
+        color=discord.Color.green() if stats.deleted == 0 else discord.Color.orange()
     )
-    embed.add_field(name="Messages Scanned", value=str(limit), inline=True)
-    embed.add_field(name="Links Deleted", value=str(deleted_count), inline=True)
+    embed.add_field(name="Messages Scanned", value=str(stats.scanned), inline=True)
+    embed.add_field(name="Links Found", value=str(stats.matched), inline=True)
+    embed.add_field(name="Links Deleted", value=str(stats.deleted), inline=True)
+    embed.add_field(name="Throughput", value=f"{stats.throughput():.0f} msg/s", inline=True)
     embed.add_field(name="Cleaner", value=ctx.author.mention, inline=True)
     
     result = await ctx.send(embed=embed)
     await result.delete(delay=30)
     
-    if deleted_count > 0:
-        await ctx.send(f"✅ Cleaned {deleted_count} non-whitelisted links.", delete_after=10)
+    if stats.deleted > 0:
+        await ctx.send(f"✅ Cleaned {stats.deleted} non-whitelisted links.", delete_after=10)
+
+def sweep_targets(guild):
+    """Text channels and active threads the bot can read and clean"""
+    targets = []
+    for channel in list(guild.text_channels) + list(guild.threads):
+        permissions = channel.permissions_for(guild.me)
+        if permissions.read_message_history and permissions.manage_messages:
+            targets.append(channel)
+    return targets
+
+@bot.command(name='cleanserver')
+@commands.is_owner()
+async def clean_server(ctx, limit: int = 500):
+    """Clean up non-whitelisted links in every channel and thread (Owner Only)"""
+    if limit > CLEAN_MAX_MESSAGES:
+        limit = CLEAN_MAX_MESSAGES
+    
+    channels = sweep_targets(ctx.guild)
+    status = await ctx.send(
+        f"🧹 Sweeping {len(channels)} channels (up to {limit} messages each)...\n"
+        f"React with ❌ to cancel."
+    )
+    await status.add_reaction('❌')
+    
+    stats = CleanStats()
+    slots = asyncio.Semaphore(SWEEP_CONCURRENCY)
+    finished = []
+    
+    async def sweep(channel):
+        async with slots:
+            try:
+                await clean_channel(channel, limit, stats)
+            except discord.HTTPException as e:
+                print(f"Error cleaning #{channel.name}: {e}")
+            finished.append(channel)
+    
+    def check(reaction, user):
+        return user == ctx.author and str(reaction.emoji) == '❌' and reaction.message.id == status.id
+    
+    sweeps = asyncio.ensure_future(asyncio.gather(*(sweep(channel) for channel in channels)))
+    cancel = asyncio.ensure_future(bot.wait_for('reaction_add', check=check))
+    cancelled = False
+    
+    while not sweeps.done():
+        done, _ = await asyncio.wait({sweeps, cancel}, timeout=SWEEP_PROGRESS_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+        if cancel in done:
+            cancelled = True
+            sweeps.cancel()
+            break
+        if not sweeps.done():
+            try:
+                await status.edit(
+                    content=f"🧹 Sweeping... {len(finished)}/{len(channels)} channels\n"
+                           f"Scanned: {stats.scanned} | Found: {stats.matched} | Deleted: {stats.deleted}\n"
+                           f"React with ❌ to cancel."
+                )
+            except:
+                pass
+    
+    cancel.cancel()
+    try:
+        await sweeps
+    except asyncio.CancelledError:
+        pass
+    
+    embed = discord.Embed(
+        title="🛑 Server Sweep Cancelled" if cancelled else "🧹 Server Sweep Complete",
+        color=discord.Color.green() if stats.deleted == 0 else discord.Color.orange()
+    )
+    embed.add_field(name="Channels", value=f"{len(finished)}/{len(channels)}", inline=True)
+    embed.add_field(name="Messages Scanned", value=str(stats.scanned), inline=True)
+    embed.add_field(name="Links Found", value=str(stats.matched), inline=True)
+    embed.add_field(name="Links Deleted", value=str(stats.deleted), inline=True)
+    embed.add_field(name="Throughput", value=f"{stats.throughput():.0f} msg/s", inline=True)
+    embed.add_field(name="Cleaner", value=ctx.author.mention, inline=True)
+    
+    try:
+        await status.clear_reactions()
+    except:
+        pass
+    await status.edit(content=None, embed=embed)
 
 # Error handling
 @bot.event
@@ -774,16 +3607,43 @@ async def on_command_error(ctx, error):
         if ctx.author.id == OWNER_ID:
             await ctx.send(f"❌ Error: {str(error)[:100]}", delete_after=10)
 
+def shard_environments(shard_count, processes):
+    """Environment for each launched process, which runs every processes-th shard"""
+    environments = []
+    for n in range(processes):
+        shard_ids = ",".join(str(shard) for shard in range(n, shard_count, processes))
+        environments.append(dict(os.environ, LINKBOT_SHARD_COUNT=str(shard_count), LINKBOT_SHARD_IDS=shard_ids))
+    return environments
+
+def launch_processes(processes):
+    """Run this script in several processes, each with every processes-th shard"""
+    children = []
+    for env in shard_environments(SHARD_COUNT, processes):
+        children.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+        print(f"Started process {children[-1].pid} for shards {env['LINKBOT_SHARD_IDS']}")
+    try:
+        for child in children:
+            child.wait()
+    except KeyboardInterrupt:
+        # Children got the same interrupt; let them flush their writes
+        for child in children:
+            child.wait()
+
 # Run the bot
 if __name__ == "__main__":
     print("=" * 50)
     print("LINK REMOVER BOT - OWNER & WHITELIST ONLY")
     print("=" * 50)
     print(f"Owner ID: {OWNER_ID}")
-    print(f"Whitelisted Users: {len(bot.whitelist_data['whitelisted_users'])}")
-    print(f"Whitelisted Roles: {len(bot.whitelist_data['whitelisted_roles'])}")
+    print(f"Whitelisted Users: {count_entries('users')}")
+    print(f"Whitelisted Roles: {count_entries('roles')}")
     print("=" * 50)
     print("Only owner and whitelisted users can post links")
     print("=" * 50)
     
-    bot.run(TOKEN)
\ No newline at end of file
+    if SHARD_COUNT and SHARD_PROCESSES > 1 and not SHARD_IDS:
+        launch_processes(min(SHARD_PROCESSES, SHARD_COUNT))
+    else:
+        scan_pool.start()
+        bot.run(TOKEN)
+        data_writer.flush()
\ No newline at end of file